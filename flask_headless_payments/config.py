@@ -9,6 +9,7 @@ DEFAULT_CONFIG = {
     # Core settings
     'PAYMENTSVC_URL_PREFIX': '/api/payments',
     'PAYMENTSVC_TABLE_PREFIX': 'paymentsvc',
+    'PAYMENTSVC_CREATE_TABLES': True,  # Run db.create_all() in init_app (False if you manage the schema)
     
     # Stripe settings
     'STRIPE_API_KEY': None,  # Must be set by user
@@ -26,6 +27,17 @@ DEFAULT_CONFIG = {
     
     # Webhook configuration
     'PAYMENTSVC_WEBHOOK_TOLERANCE': 300,  # 5 minutes
+    'PAYMENTSVC_WEBHOOK_MAX_BYTES': 256 * 1024,  # Larger bodies get 413 before verification
+    'PAYMENTSVC_WEBHOOK_ASYNC': False,  # Acknowledge first, process on worker threads
+    'PAYMENTSVC_WEBHOOK_WORKERS': 4,
+    'PAYMENTSVC_WEBHOOK_QUEUE_SIZE': 1000,
+    'PAYMENTSVC_WEBHOOK_BATCH_SIZE': 50,  # Events per worker batch (one user query each)
+    'PAYMENTSVC_WEBHOOK_REDRIVE_INTERVAL': 60,  # Seconds between retries of failed/stranded async events
+    'PAYMENTSVC_WEBHOOK_MAX_RETRIES': 5,  # Retries per async event before it is left for inspection
+    'PAYMENTSVC_WEBHOOK_STALE_AFTER': 300,  # Unprocessed rows older than this may be claimed again
+    'PAYMENTSVC_WEBHOOK_METRICS': False,  # Expose GET /webhook/metrics (unauthenticated)
+    # Log-only event types acknowledged without a DB write (set [] to keep an audit row)
+    'PAYMENTSVC_WEBHOOK_SKIP_PERSIST': ['invoice.payment_succeeded', 'invoice.payment_failed'],
     
     # Frontend URLs (for redirects)
     'PAYMENTSVC_SUCCESS_URL': 'http://localhost:3000/success',
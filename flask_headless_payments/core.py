@@ -10,6 +10,8 @@ from typing import Optional, Dict, Any
 import logging
 import stripe
 
+from flask_headless_payments.utils.schema import has_index
+
 logger = logging.getLogger(__name__)
 
 
@@ -78,6 +80,7 @@ class PaymentSvc:
         self.subscription_manager = None
         self.checkout_manager = None
         self.webhook_manager = None
+        self.webhook_processor = None
         self.plan_manager = None
         
         if app is not None:
@@ -210,9 +213,10 @@ class PaymentSvc:
         self._validate_models()
         
         # Create tables
-        with app.app_context():
-            self.db.create_all()
-            logger.info("Payment database tables created")
+        if app.config.get('PAYMENTSVC_CREATE_TABLES', True):
+            with app.app_context():
+                self.db.create_all()
+                logger.info("Payment database tables created")
     
     def _validate_models(self):
         """
@@ -240,6 +244,15 @@ class PaymentSvc:
                     errors.append(
                         f"WebhookEvent model missing required field '{field}' ({description})"
                     )
+            
+            # Duplicate deliveries are detected via the unique constraint
+            table = self.webhook_event_model.__table__
+            if 'stripe_event_id' in table.columns:
+                if not has_index(table, 'stripe_event_id', unique=True):
+                    warnings.append(
+                        "WebhookEvent.stripe_event_id is not unique - "
+                        "concurrent duplicate Stripe deliveries may be processed twice"
+                    )
         
         # Required fields for Customer model
         customer_required = {
@@ -256,6 +269,24 @@ class PaymentSvc:
                         f"Customer model missing required field '{field}' ({description})"
                     )
         
+        # Columns every webhook and route lookup filters on
+        lookup_columns = []
+        if self.user_model is not None and hasattr(self.user_model, '__table__'):
+            lookup_columns += [
+                (self.user_model, 'stripe_customer_id'),
+                (self.user_model, 'stripe_subscription_id'),
+            ]
+        if self.customer_model:
+            lookup_columns.append((self.customer_model, 'user_id'))
+        
+        for model, column_name in lookup_columns:
+            table = model.__table__
+            if column_name in table.columns and not has_index(table, column_name):
+                warnings.append(
+                    f"{model.__name__}.{column_name} has no index - webhook lookups "
+                    f"will scan the table. Add index=True to the column."
+                )
+        
         # Required fields for Payment model
         payment_required = {
             'user_id': 'Integer - Reference to User',
@@ -308,35 +339,51 @@ class PaymentSvc:
     def _init_managers(self, app):
         """Initialize manager instances."""
         from flask_headless_payments.managers import (
-            SubscriptionManager, CheckoutManager, WebhookManager, PlanManager
+            SubscriptionManager, CheckoutManager, WebhookManager, WebhookProcessor, PlanManager
         )
         
+        # Plan Manager (first - the subscription manager maps price IDs to plans)
+        if not self.plans:
+            logger.warning("No plans configured. Define plans for subscription management.")
+            self.plans = {'free': {'name': 'Free', 'price_id': None}}
+        
+        self.plan_manager = PlanManager(plans=self.plans)
+        
         # Subscription Manager
         self.subscription_manager = SubscriptionManager(
             db=self.db,
             user_model=self.user_model,
             customer_model=self.customer_model,
-            payment_model=self.payment_model
+            payment_model=self.payment_model,
+            plan_manager=self.plan_manager
         )
         
         # Checkout Manager
         self.checkout_manager = CheckoutManager(config=app.config)
         
-        # Plan Manager
-        if not self.plans:
-            logger.warning("No plans configured. Define plans for subscription management.")
-            self.plans = {'free': {'name': 'Free', 'price_id': None}}
-        
-        self.plan_manager = PlanManager(plans=self.plans)
-        
         # Webhook Manager
         self.webhook_manager = WebhookManager(
             db=self.db,
             user_model=self.user_model,
             webhook_event_model=self.webhook_event_model,
-            subscription_manager=self.subscription_manager
+            subscription_manager=self.subscription_manager,
+            tolerance=app.config.get('PAYMENTSVC_WEBHOOK_TOLERANCE', 300),
+            skip_persist=app.config.get('PAYMENTSVC_WEBHOOK_SKIP_PERSIST'),
+            stale_after=app.config.get('PAYMENTSVC_WEBHOOK_STALE_AFTER', 300)
         )
         
+        # Webhook Processor (background event processing)
+        if app.config.get('PAYMENTSVC_WEBHOOK_ASYNC', False):
+            self.webhook_processor = WebhookProcessor(
+                webhook_manager=self.webhook_manager,
+                max_queue_size=app.config.get('PAYMENTSVC_WEBHOOK_QUEUE_SIZE', 1000),
+                workers=app.config.get('PAYMENTSVC_WEBHOOK_WORKERS', 4),
+                batch_size=app.config.get('PAYMENTSVC_WEBHOOK_BATCH_SIZE', 50),
+                redrive_interval=app.config.get('PAYMENTSVC_WEBHOOK_REDRIVE_INTERVAL', 60),
+                max_retries=app.config.get('PAYMENTSVC_WEBHOOK_MAX_RETRIES', 5)
+            )
+            self.webhook_processor.start(app)
+        
         logger.info("Payment managers initialized")
     
     def _init_cors(self, app):
@@ -374,6 +421,7 @@ class PaymentSvc:
             checkout_manager=self.checkout_manager,
             webhook_manager=self.webhook_manager,
             plan_manager=self.plan_manager,
+            webhook_processor=self.webhook_processor,
             config=app.config,
             blueprint_name=self.blueprint_name,  # Pass unique blueprint name
             webhook_secret=self.webhook_secret  # Pass instance-level webhook secret
@@ -27,6 +27,8 @@ def requires_plan(*allowed_plans):
     Args:
         *allowed_plans: Plan name(s) that are allowed to access the resource
     """
+    allowed_plan_set = frozenset(allowed_plans)
+    
     def decorator(fn):
         @wraps(fn)
         def wrapper(*args, **kwargs):
@@ -56,7 +58,7 @@ def requires_plan(*allowed_plans):
                 }), 403
             
             # Check if user's plan is in allowed plans
-            if user.plan_name not in allowed_plans:
+            if user.plan_name not in allowed_plan_set:
                 return jsonify({
                     'error': 'Insufficient plan',
                     'message': f'This feature requires one of: {", ".join(allowed_plans)}',
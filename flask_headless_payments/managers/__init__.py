@@ -8,12 +8,14 @@ Manager classes for payment business logic.
 from .subscription_manager import SubscriptionManager
 from .checkout_manager import CheckoutManager
 from .webhook_manager import WebhookManager
+from .webhook_processor import WebhookProcessor
 from .plan_manager import PlanManager
 
 __all__ = [
     'SubscriptionManager',
     'CheckoutManager',
     'WebhookManager',
+    'WebhookProcessor',
     'PlanManager',
 ]
 
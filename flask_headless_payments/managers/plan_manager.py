@@ -12,7 +12,12 @@ logger = logging.getLogger(__name__)
 
 
 class PlanManager:
-    """Manages subscription plans and access control."""
+    """
+    Manages subscription plans and access control.
+    
+    Price ID and rank lookups are built once from the plans passed in;
+    create a new PlanManager to change plans.
+    """
     
     def __init__(self, plans: Dict[str, Dict[str, Any]]):
         """
@@ -38,6 +43,7 @@ class PlanManager:
         """
         self.plans = plans
         self._validate_plans()
+        self._build_index()
     
     def _validate_plans(self):
         """Validate plan configuration."""
@@ -51,6 +57,19 @@ class PlanManager:
             if 'name' not in plan_config:
                 raise ValueError(f"Plan '{plan_name}' missing 'name' field")
     
+    def _build_index(self):
+        """Precompute price IDs, plan names by price ID and plan ranks."""
+        self._price_ids = {
+            plan_name: plan_config.get('price_id')
+            for plan_name, plan_config in self.plans.items()
+        }
+        self._plans_by_price_id = {
+            price_id: plan_name
+            for plan_name, price_id in self._price_ids.items()
+            if price_id
+        }
+        self._ranks = {plan_name: rank for rank, plan_name in enumerate(self.plans)}
+    
     def get_plan(self, plan_name: str) -> Optional[Dict[str, Any]]:
         """
         Get plan configuration.
@@ -139,20 +158,17 @@ class PlanManager:
         Returns:
             int: -1 if plan1 < plan2, 0 if equal, 1 if plan1 > plan2
         """
-        # Define plan hierarchy (customize as needed)
-        hierarchy = list(self.plans.keys())
+        # Plan hierarchy follows configuration order (customize as needed)
+        idx1 = self._ranks.get(plan1)
+        idx2 = self._ranks.get(plan2)
         
-        try:
-            idx1 = hierarchy.index(plan1)
-            idx2 = hierarchy.index(plan2)
-            
-            if idx1 < idx2:
-                return -1
-            elif idx1 > idx2:
-                return 1
-            else:
-                return 0
-        except ValueError:
+        if idx1 is None or idx2 is None:
+            return 0
+        if idx1 < idx2:
+            return -1
+        elif idx1 > idx2:
+            return 1
+        else:
             return 0
     
     def is_upgrade(self, from_plan: str, to_plan: str) -> bool:
@@ -191,6 +207,17 @@ class PlanManager:
         Returns:
             str: Stripe price ID or None
         """
-        plan = self.get_plan(plan_name)
-        return plan.get('price_id') if plan else None
+        return self._price_ids.get(plan_name)
+    
+    def get_plan_by_price_id(self, price_id: str) -> Optional[str]:
+        """
+        Get the plan name for a Stripe price ID.
+        
+        Args:
+            price_id: Stripe price ID (e.g. from a subscription item)
+        
+        Returns:
+            str: Plan name or None
+        """
+        return self._plans_by_price_id.get(price_id)
 
@@ -39,7 +39,8 @@ class SubscriptionManager:
     - Customizable via inheritance
     """
     
-    def __init__(self, db, user_model, customer_model, payment_model, idempotency_manager=None):
+    def __init__(self, db, user_model, customer_model, payment_model, idempotency_manager=None,
+                 plan_manager=None):
         """
         Initialize subscription manager.
         
@@ -49,12 +50,15 @@ class SubscriptionManager:
             customer_model: Customer model class
             payment_model: Payment model class
             idempotency_manager: IdempotencyManager instance (optional)
+            plan_manager: PlanManager instance (optional), used to map price IDs
+                without plan_name metadata back to a configured plan
         """
         self.db = db
         self.user_model = user_model
         self.customer_model = customer_model
         self.payment_model = payment_model
         self.idempotency_manager = idempotency_manager
+        self.plan_manager = plan_manager
         
         # Get extension managers
         self.hook_manager = get_hook_manager()
@@ -132,6 +136,12 @@ class SubscriptionManager:
                     name=name
                 )
                 self.db.session.add(customer)
+                
+                # Link the user in the same transaction (no second commit in the caller)
+                user = self.user_model.query.get(user_id)
+                if user is not None and hasattr(user, 'stripe_customer_id') and not user.stripe_customer_id:
+                    user.stripe_customer_id = stripe_customer.id
+                
                 self.db.session.commit()  # Customer creation needs immediate commit for Stripe consistency
                 
                 # Save idempotency result
@@ -324,12 +334,15 @@ class SubscriptionManager:
             if subscription_data.get('trial_end'):
                 user.trial_end = datetime.fromtimestamp(subscription_data['trial_end'])
             
-            # Extract plan name from Stripe price metadata (if set)
-            # Only overwrite if the metadata actually contains a non-empty plan_name
+            # Extract plan name from Stripe price metadata (if set), falling back
+            # to the configured plan with this price ID
+            # Only overwrite if a non-empty plan name was found
             if subscription_data.get('items') and subscription_data['items'].get('data'):
                 first_item = subscription_data['items']['data'][0]
-                price_meta = (first_item.get('price') or {}).get('metadata') or {}
-                meta_plan = price_meta.get('plan_name')
+                price = first_item.get('price') or {}
+                meta_plan = (price.get('metadata') or {}).get('plan_name')
+                if not meta_plan and self.plan_manager is not None:
+                    meta_plan = self.plan_manager.get_plan_by_price_id(price.get('id'))
                 if meta_plan:
                     user.plan_name = meta_plan
             
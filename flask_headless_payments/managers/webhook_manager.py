@@ -7,16 +7,30 @@ Webhook event handling.
 
 import stripe
 import logging
-from datetime import datetime
-from typing import Dict, Any, Callable, Optional
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, Any, Callable, Iterable, List, Optional
+from sqlalchemy import and_, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+from flask_headless_payments.utils.clock import utcnow
+from flask_headless_payments.utils.schema import has_index
 
 logger = logging.getLogger(__name__)
 
+# Concurrent Stripe requests per batch when prefetching subscriptions
+_MAX_SUBSCRIPTION_FETCHES = 8
+
+# Session.info key for the users prefetched by process_recorded_events()
+_BATCH_USERS_KEY = 'paymentsvc_batch_users'
+
 
 class WebhookManager:
     """Manages Stripe webhook events with proper transaction handling."""
     
-    def __init__(self, db, user_model, webhook_event_model, subscription_manager):
+    def __init__(self, db, user_model, webhook_event_model, subscription_manager,
+                 tolerance: int = 300, skip_persist: Optional[Iterable[str]] = None,
+                 stale_after: int = 300):
         """
         Initialize webhook manager.
         
@@ -25,13 +39,34 @@ class WebhookManager:
             user_model: User model class
             webhook_event_model: WebhookEvent model class
             subscription_manager: SubscriptionManager instance
+            tolerance: Maximum age of a webhook signature in seconds
+            skip_persist: Log-only event types to acknowledge without storing (optional)
+            stale_after: Seconds after which an unprocessed event row may be claimed again
         """
         self.db = db
         self.user_model = user_model
         self.webhook_event_model = webhook_event_model
         self.subscription_manager = subscription_manager
+        self.tolerance = tolerance
+        self.skip_persist = frozenset(skip_persist or ())
+        self.stale_after = stale_after
+        
+        # ON CONFLICT needs a unique index to infer; custom models may lack one
+        self._stripe_event_id_unique = has_index(
+            webhook_event_model.__table__, 'stripe_event_id', unique=True
+        )
         self.event_handlers = {}
         self.post_commit_callbacks = {}  # For business logic after successful commit
+        
+        # Built-in handlers by event type (custom handlers take precedence)
+        self._default_handlers = {
+            'checkout.session.completed': self._handle_checkout_completed,
+            'customer.subscription.created': self._handle_subscription_created,
+            'customer.subscription.updated': self._handle_subscription_updated,
+            'customer.subscription.deleted': self._handle_subscription_deleted,
+            'invoice.payment_succeeded': self._handle_invoice_paid,
+            'invoice.payment_failed': self._handle_invoice_failed,
+        }
     
     def verify_webhook(self, payload: bytes, sig_header: str, webhook_secret: str) -> Optional[Dict[str, Any]]:
         """
@@ -43,13 +78,12 @@ class WebhookManager:
             webhook_secret: Webhook secret from Stripe
             
         Returns:
-            dict: Stripe event object or None if verification fails
+            stripe.Event: Verified event or None if verification fails
         """
         try:
-            event = stripe.Webhook.construct_event(
-                payload, sig_header, webhook_secret
+            return stripe.Webhook.construct_event(
+                payload, sig_header, webhook_secret, tolerance=self.tolerance
             )
-            return event
         except ValueError as e:
             logger.error(f"Invalid payload: {e}")
             return None
@@ -100,6 +134,25 @@ class WebhookManager:
         self.post_commit_callbacks[event_type].append(callback)
         logger.info(f"Registered post-commit callback for {event_type}")
     
+    def skips_persistence(self, event_type: str) -> bool:
+        """
+        Check whether an event type is acknowledged without touching the database.
+        
+        Only applies while no custom handler or post-commit callback is
+        registered for the type, since those expect the stored event.
+        
+        Args:
+            event_type: Stripe event type
+        
+        Returns:
+            bool: True if the event can be skipped
+        """
+        return (
+            event_type in self.skip_persist and
+            event_type not in self.event_handlers and
+            event_type not in self.post_commit_callbacks
+        )
+    
     def process_event(self, event: Dict[str, Any]) -> bool:
         """
         Process a webhook event in a single transaction.
@@ -109,6 +162,15 @@ class WebhookManager:
         - On success: single commit at the end
         - On failure: full rollback, then error is logged separately
         
+        Duplicate deliveries:
+        - The event row is inserted with ON CONFLICT DO NOTHING on stripe_event_id
+        - Events already stored are acknowledged without running handlers
+        - Events whose previous attempt failed, or that were recorded but left
+          unprocessed for longer than stale_after seconds, are processed again
+        
+        Log-only events (see skips_persistence()) are acknowledged without
+        a database write.
+        
         Post-commit callbacks:
         - Run AFTER successful commit
         - Failures in callbacks don't affect the webhook processing
@@ -121,30 +183,32 @@ class WebhookManager:
             bool: True if processed successfully, False otherwise
         """
         event_type = event['type']
+        
+        if self.skips_persistence(event_type):
+            logger.info(f"Acknowledged event {event['id']} of type {event_type} without storing it")
+            return True
+        
         event_data = event['data']['object']
         affected_user = None  # Track user for post-commit callbacks
+        now = utcnow()  # Received and processed in the same transaction
         
         try:
             # Create webhook event record (will be committed with everything else)
-            webhook_event = self.webhook_event_model(
-                stripe_event_id=event['id'],
-                event_type=event_type,
-                data=event_data,
-                received_at=datetime.utcnow()
-            )
-            self.db.session.add(webhook_event)
+            webhook_event_id = self._claim_event_row(event['id'], event_type, event_data, received_at=now)
+            if webhook_event_id is None:
+                self.db.session.rollback()
+                logger.info(f"Skipping duplicate event {event['id']} of type {event_type}")
+                return True
             
             # Process the event - handlers should NOT commit
-            if event_type in self.event_handlers:
-                # Custom handlers receive commit=False to indicate they shouldn't commit
-                self.event_handlers[event_type](event_data, self.db, self.user_model, commit=False)
-            else:
-                # Default handlers - get affected user for callbacks
-                affected_user = self._handle_default_event(event_type, event_data, commit=False)
+            affected_user = self._dispatch_event(event_type, event_data)
             
             # Mark as processed
-            webhook_event.processed = True
-            webhook_event.processed_at = datetime.utcnow()
+            self.db.session.execute(
+                update(self.webhook_event_model)
+                .where(self.webhook_event_model.id == webhook_event_id)
+                .values(processed=True, processed_at=now, error=None)
+            )
             
             # SINGLE COMMIT for entire transaction
             self.db.session.commit()
@@ -167,6 +231,405 @@ class WebhookManager:
             
             return False
     
+    def record_event(self, event: Dict[str, Any]) -> Optional[int]:
+        """
+        Persist a verified event as unprocessed, without running handlers.
+        
+        Used by the webhook route when events are processed in the background:
+        the row is committed before Stripe gets its 200, so a crash between
+        acknowledging and processing leaves an unprocessed row behind rather
+        than losing the event.
+        
+        Args:
+            event: Stripe event object
+        
+        Returns:
+            int: Primary key of the recorded WebhookEvent row, or None if the
+                event was already recorded (duplicate delivery)
+        """
+        try:
+            webhook_event_id = self._claim_event_row(event['id'], event['type'], event['data']['object'])
+            self.db.session.commit()
+            
+            if webhook_event_id is None:
+                logger.info(f"Skipping duplicate event {event['id']} of type {event['type']}")
+            
+            return webhook_event_id
+        except Exception:
+            self.db.session.rollback()
+            raise
+    
+    def process_recorded_event(self, webhook_event_id: int) -> bool:
+        """
+        Process an event previously stored with record_event().
+        
+        Same transaction behavior as process_event(): handler changes and the
+        processed flag are committed together, and on failure the error is
+        written to the row in a separate transaction.
+        
+        Args:
+            webhook_event_id: Primary key of the recorded WebhookEvent row
+        
+        Returns:
+            bool: True if processed successfully, False otherwise
+        """
+        model = self.webhook_event_model
+        
+        # Column-only read - the row is only ever updated by id, so it doesn't
+        # need to go through the ORM identity map
+        row = self.db.session.execute(
+            select(model.stripe_event_id, model.event_type, model.data, model.processed)
+            .where(model.id == webhook_event_id)
+        ).first()
+        if row is None:
+            logger.error(f"Webhook event row {webhook_event_id} not found")
+            return False
+        
+        stripe_event_id, event_type, event_data, processed = row
+        if processed:
+            return True
+        
+        return self._process_row(webhook_event_id, stripe_event_id, event_type, event_data)
+    
+    def process_recorded_events(self, webhook_event_ids: List[int],
+                                queued_at: Optional[Dict[int, datetime]] = None) -> List[bool]:
+        """
+        Process a batch of recorded events, resolving their users in one query.
+        
+        Each event still gets its own transaction. Users for every
+        stripe_customer_id in the batch are loaded with a single IN query
+        instead of one SELECT per event, and subscriptions for checkout
+        sessions are retrieved from Stripe concurrently up front.
+        
+        Only call this from a session that is discarded afterwards (the
+        webhook worker's app context): the session stops expiring objects on
+        commit so the prefetched users survive the per-event commits.
+        
+        With queued_at, each row is leased before its handlers run: rows taken
+        over by another process since they were queued (see _reclaimable())
+        are skipped, and the rest get received_at refreshed so they don't look
+        stale to other sweepers while they are being processed.
+        
+        Args:
+            webhook_event_ids: Primary keys of recorded WebhookEvent rows
+            queued_at: Row id -> when this process queued it (optional)
+        
+        Returns:
+            list: Success flag per event, in the same order (True for rows
+                that were already processed or are owned by another process)
+        """
+        model = self.webhook_event_model
+        self.db.session().expire_on_commit = False
+        
+        rows = {
+            row.id: row for row in self.db.session.execute(
+                select(model.id, model.stripe_event_id, model.event_type, model.data, model.processed)
+                .where(model.id.in_(webhook_event_ids))
+            )
+        }
+        
+        skipped = set()
+        if queued_at:
+            leases = {
+                row.id: queued_at[row.id] for row in rows.values()
+                if not row.processed and row.id in queued_at
+            }
+            skipped = set(leases) - self._renew_leases(leases)
+            for webhook_event_id in skipped:
+                logger.info(f"Webhook event row {webhook_event_id} was claimed by another worker, skipping")
+        
+        pending = [row for row in rows.values() if not row.processed and row.id not in skipped]
+        
+        # Batch-scoped on purpose: a request handles one event in a fresh
+        # session, where a cached id would only swap one indexed SELECT for a
+        # primary key one. The map also keeps the users referenced, which the
+        # identity map alone does not.
+        session = self.db.session()
+        users = {
+            user.stripe_customer_id: user for user in self._prefetch_users(
+                row.data.get('customer') for row in pending if isinstance(row.data, dict)
+            )
+        }
+        subscriptions = self._prefetch_subscriptions(
+            (row.data for row in pending if row.event_type == 'checkout.session.completed'), users
+        )
+        
+        session.info[_BATCH_USERS_KEY] = users
+        try:
+            results = []
+            for webhook_event_id in webhook_event_ids:
+                row = rows.get(webhook_event_id)
+                if row is None:
+                    logger.error(f"Webhook event row {webhook_event_id} not found")
+                    results.append(False)
+                elif row.processed or webhook_event_id in skipped:
+                    results.append(True)
+                else:
+                    # Passed next to the payload, which callbacks still get unchanged
+                    prefetched_subscription = None
+                    if row.event_type == 'checkout.session.completed' and isinstance(row.data, dict):
+                        subscription_id = row.data.get('subscription')
+                        if isinstance(subscription_id, str):
+                            prefetched_subscription = subscriptions.get(subscription_id)
+                    
+                    results.append(self._process_row(
+                        webhook_event_id, row.stripe_event_id, row.event_type, row.data,
+                        prefetched_subscription=prefetched_subscription
+                    ))
+        finally:
+            session.info.pop(_BATCH_USERS_KEY, None)
+        
+        return results
+    
+    def _process_row(self, webhook_event_id: int, stripe_event_id: str, event_type: str,
+                     event_data: Dict[str, Any], prefetched_subscription: Optional[Any] = None) -> bool:
+        """Run handlers for a recorded event and mark it processed, in one transaction."""
+        model = self.webhook_event_model
+        
+        if isinstance(event_data, dict) and not isinstance(event_data, stripe.StripeObject):
+            # Stored payloads come back as plain dicts; hand handlers what the
+            # synchronous path does
+            event_data = stripe.StripeObject.construct_from(event_data, stripe.api_key)
+        
+        try:
+            affected_user = self._dispatch_event(event_type, event_data, prefetched_subscription)
+            
+            self.db.session.execute(
+                update(model)
+                .where(model.id == webhook_event_id)
+                .values(processed=True, processed_at=utcnow(), error=None)
+            )
+            
+            self.db.session.commit()
+            
+            logger.info(f"Successfully processed event {stripe_event_id} of type {event_type}")
+            
+            self._run_post_commit_callbacks(event_type, event_data, affected_user)
+            
+            return True
+        
+        except Exception as e:
+            self.db.session.rollback()
+            
+            logger.error(f"Failed to process event {stripe_event_id}: {e}")
+            
+            self._mark_webhook_error(webhook_event_id, str(e))
+            
+            return False
+    
+    def _claim_event_row(
+        self,
+        stripe_event_id: str,
+        event_type: str,
+        event_data: Dict[str, Any],
+        received_at: Optional[datetime] = None
+    ) -> Optional[int]:
+        """
+        Insert the webhook event row, or take over an existing unprocessed row.
+        
+        An existing row is taken over when its last attempt failed or when it
+        has been waiting longer than stale_after seconds (e.g. queued by a
+        process that exited). Claiming resets received_at, so concurrent
+        deliveries of the same event cannot both claim it.
+        
+        Does not commit.
+        
+        Returns:
+            int: Row id to process, or None if the event is a duplicate
+        """
+        received_at = received_at or utcnow()
+        webhook_event_id = self._insert_event_row(
+            stripe_event_id=stripe_event_id,
+            event_type=event_type,
+            data=event_data,
+            received_at=received_at,
+            processed=False
+        )
+        if webhook_event_id is not None:
+            return webhook_event_id
+        
+        # Already stored - only a failed or stale attempt may be retried
+        model = self.webhook_event_model
+        existing_id = self.db.session.query(model.id).filter(
+            model.stripe_event_id == stripe_event_id
+        ).order_by(model.id).limit(1).scalar()
+        if existing_id is None:
+            return None
+        
+        return existing_id if self._reclaim_row(existing_id, received_at) else None
+    
+    def _reclaimable(self, now: datetime):
+        """SQL condition for unprocessed rows that failed or went stale."""
+        model = self.webhook_event_model
+        return and_(
+            model.processed.is_(False),
+            or_(
+                model.error.isnot(None),
+                model.received_at < now - timedelta(seconds=self.stale_after)
+            )
+        )
+    
+    def _reclaim_row(self, webhook_event_id: int, now: datetime) -> bool:
+        """Take over a failed or stale row. Only one concurrent caller succeeds."""
+        model = self.webhook_event_model
+        result = self.db.session.execute(
+            update(model)
+            .where(model.id == webhook_event_id, self._reclaimable(now))
+            .values(error=None, received_at=now)
+        )
+        return result.rowcount == 1
+    
+    def _renew_leases(self, queued_at: Dict[int, datetime]) -> set:
+        """
+        Refresh received_at on rows nobody has claimed since they were queued.
+        
+        Any claim sets received_at to the time of the claim, so a row whose
+        received_at is later than the time we queued it belongs to someone else.
+        
+        Returns:
+            set: Row ids leased to the caller
+        """
+        model = self.webhook_event_model
+        now = utcnow()
+        
+        try:
+            leased = {
+                webhook_event_id for webhook_event_id, queued in queued_at.items()
+                if self.db.session.execute(
+                    update(model)
+                    .where(
+                        model.id == webhook_event_id,
+                        model.processed.is_(False),
+                        model.error.is_(None),
+                        model.received_at <= queued
+                    )
+                    .values(received_at=now)
+                ).rowcount == 1
+            }
+            self.db.session.commit()
+        except Exception:
+            self.db.session.rollback()
+            raise
+        
+        return leased
+    
+    def claim_stale_events(self, limit: int = 100, exclude: Iterable[int] = ()) -> List[int]:
+        """
+        Claim recorded events that failed or were never processed, for a retry.
+        
+        Covers rows whose worker raised (Stripe already got its 200, so it
+        will not re-deliver them) and rows stranded in the queue of a process
+        that exited. Each row is claimed with a conditional UPDATE, so when
+        several processes sweep at once every row goes to exactly one of them.
+        
+        Args:
+            limit: Maximum number of rows to claim
+            exclude: Row ids to leave alone (queued locally or out of retries)
+        
+        Returns:
+            list: Claimed row ids, committed and ready for process_recorded_events()
+        """
+        model = self.webhook_event_model
+        now = utcnow()
+        exclude = list(exclude)
+        
+        stmt = select(model.id).where(self._reclaimable(now))
+        if exclude:
+            stmt = stmt.where(model.id.notin_(exclude))
+        candidate_ids = self.db.session.execute(stmt.order_by(model.id).limit(limit)).scalars().all()
+        
+        try:
+            claimed = [
+                webhook_event_id for webhook_event_id in candidate_ids
+                if self._reclaim_row(webhook_event_id, now)
+            ]
+            self.db.session.commit()
+        except Exception:
+            self.db.session.rollback()
+            raise
+        
+        if claimed:
+            logger.info(f"Claimed {len(claimed)} failed or stale webhook events for retry")
+        
+        return claimed
+    
+    def _insert_event_row(self, **values) -> Optional[int]:
+        """
+        INSERT a webhook event row, ignoring conflicts on stripe_event_id.
+        
+        Uses INSERT ... ON CONFLICT DO NOTHING RETURNING id on PostgreSQL and
+        SQLite, so duplicates are detected atomically in one statement. Other
+        backends fall back to a savepoint around a regular insert. Both paths
+        are Core inserts; the row never enters the ORM unit of work.
+        
+        Both rely on a unique index on stripe_event_id. Without one, the
+        existing row is looked up before inserting, which does not protect
+        against two concurrent deliveries of the same event.
+        
+        Returns:
+            int: New row id, or None if a row with this stripe_event_id exists
+        """
+        model = self.webhook_event_model
+        dialect = self.db.engine.dialect
+        
+        if not self._stripe_event_id_unique:
+            existing_id = self.db.session.execute(
+                select(model.id).where(model.stripe_event_id == values['stripe_event_id']).limit(1)
+            ).scalar()
+            if existing_id is not None:
+                return None
+            return self.db.session.execute(insert(model).values(**values)).inserted_primary_key[0]
+        
+        if dialect.name in ('postgresql', 'sqlite') and getattr(dialect, 'insert_returning', False):
+            if dialect.name == 'postgresql':
+                from sqlalchemy.dialects.postgresql import insert as dialect_insert
+            else:
+                from sqlalchemy.dialects.sqlite import insert as dialect_insert
+            
+            stmt = (
+                dialect_insert(model)
+                .values(**values)
+                .on_conflict_do_nothing(index_elements=['stripe_event_id'])
+                .returning(model.id)
+            )
+            return self.db.session.execute(stmt).scalar()
+        
+        try:
+            with self.db.session.begin_nested():
+                result = self.db.session.execute(insert(model).values(**values))
+            return result.inserted_primary_key[0]
+        except IntegrityError:
+            return None
+    
+    def _dispatch_event(self, event_type: str, event_data: Dict[str, Any],
+                        prefetched_subscription: Optional[Any] = None) -> Optional[Any]:
+        """
+        Run the custom or default handler for an event. Handlers do NOT commit.
+        
+        Args:
+            event_type: Stripe event type
+            event_data: Event payload (data.object)
+            prefetched_subscription: Subscription already retrieved for a
+                checkout session (only collected when the default checkout
+                handler is in use)
+        
+        Returns:
+            User object if found by a default handler, for post-commit callbacks
+        """
+        custom_handler = self.event_handlers.get(event_type)
+        if custom_handler is not None:
+            # Custom handlers receive commit=False to indicate they shouldn't commit
+            custom_handler(event_data, self.db, self.user_model, commit=False)
+            return None
+        
+        if prefetched_subscription is not None and event_type == 'checkout.session.completed':
+            return self._handle_checkout_completed(
+                event_data, commit=False, prefetched_subscription=prefetched_subscription
+            )
+        
+        # Default handlers - get affected user for callbacks
+        return self._handle_default_event(event_type, event_data, commit=False)
+    
     def _run_post_commit_callbacks(self, event_type: str, event_data: Dict[str, Any], user: Any):
         """
         Run post-commit callbacks for business logic.
@@ -188,21 +651,129 @@ class WebhookManager:
         Log webhook error in a separate transaction.
         
         This ensures error logging doesn't fail due to the rolled-back transaction.
+        If the row already exists (a failed retry), its error is updated instead.
         """
         try:
-            webhook_event = self.webhook_event_model(
+            webhook_event_id = self._insert_event_row(
                 stripe_event_id=event_id,
                 event_type=event_type,
                 data=event_data,
-                received_at=datetime.utcnow(),
+                received_at=utcnow(),
                 processed=False,
                 error=error
             )
-            self.db.session.add(webhook_event)
+            if webhook_event_id is None:
+                self.db.session.execute(
+                    update(self.webhook_event_model)
+                    .where(
+                        self.webhook_event_model.stripe_event_id == event_id,
+                        self.webhook_event_model.processed.is_(False)
+                    )
+                    .values(error=error)
+                )
+            self.db.session.commit()
+        except Exception as log_error:
+            self.db.session.rollback()
+            logger.error(f"Failed to log webhook error: {log_error}")
+    
+    def _mark_webhook_error(self, webhook_event_id: int, error: str):
+        """Record a processing error on an already-stored webhook event row."""
+        try:
+            self.db.session.execute(
+                update(self.webhook_event_model)
+                .where(self.webhook_event_model.id == webhook_event_id)
+                .values(processed=False, error=error)
+            )
             self.db.session.commit()
         except Exception as log_error:
+            self.db.session.rollback()
             logger.error(f"Failed to log webhook error: {log_error}")
     
+    def _prefetch_users(self, customer_ids: Iterable[Optional[str]]) -> List[Any]:
+        """
+        Load users for several Stripe customer IDs with one IN query.
+        
+        process_recorded_events() exposes them to _get_user_by_customer()
+        for the rest of the batch, so handlers don't SELECT them again.
+        
+        Returns:
+            list: Loaded users
+        """
+        customer_ids = {customer_id for customer_id in customer_ids if customer_id}
+        if not customer_ids or not hasattr(self.user_model, 'stripe_customer_id'):
+            return []
+        
+        users = self.user_model.query.filter(
+            self.user_model.stripe_customer_id.in_(customer_ids)
+        ).all()
+        return users
+    
+    def _prefetch_subscriptions(self, sessions: Iterable[Dict[str, Any]],
+                                users: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Retrieve the subscriptions of several checkout sessions concurrently.
+        
+        Only sessions _handle_checkout_completed() would call Stripe for are
+        fetched: a bare subscription id and a user already found by
+        _prefetch_users(). Failed lookups are left out, so the handler
+        retries them and records any error on the event.
+        
+        Args:
+            sessions: Checkout session payloads
+            users: Prefetched users by Stripe customer ID
+        
+        Returns:
+            dict: Subscription objects by subscription ID
+        """
+        if 'checkout.session.completed' in self.event_handlers:
+            return {}
+        
+        subscription_ids = {
+            session['subscription'] for session in sessions
+            if isinstance(session, dict) and isinstance(session.get('subscription'), str)
+            and session.get('customer') in users
+        }
+        if len(subscription_ids) < 2:
+            # Nothing to overlap - let the handler fetch it
+            return {}
+        
+        subscriptions = {}
+        workers = min(len(subscription_ids), _MAX_SUBSCRIPTION_FETCHES)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                subscription_id: executor.submit(stripe.Subscription.retrieve, subscription_id)
+                for subscription_id in subscription_ids
+            }
+            for subscription_id, future in futures.items():
+                try:
+                    subscriptions[subscription_id] = future.result()
+                except Exception as e:
+                    logger.warning(f"Failed to prefetch subscription {subscription_id}: {e}")
+        
+        return subscriptions
+    
+    def _get_user_by_customer(self, customer_id: Optional[str]) -> Optional[Any]:
+        """
+        Find the user for a Stripe customer ID.
+        
+        Inside process_recorded_events() the users prefetched for the batch
+        are used; otherwise this is a single indexed SELECT.
+        
+        Args:
+            customer_id: Stripe customer ID
+        
+        Returns:
+            User object or None
+        """
+        if not customer_id:
+            return None
+        
+        user = self.db.session().info.get(_BATCH_USERS_KEY, {}).get(customer_id)
+        if user is not None and user.stripe_customer_id == customer_id:
+            return user
+        
+        return self.user_model.query.filter_by(stripe_customer_id=customer_id).first()
+    
     def _handle_default_event(self, event_type: str, event_data: Dict[str, Any], commit: bool = False) -> Optional[Any]:
         """
         Handle default events.
@@ -215,52 +786,39 @@ class WebhookManager:
         Returns:
             User object if found, for post-commit callbacks
         """
-        user = None
-        
-        if event_type == 'checkout.session.completed':
-            user = self._handle_checkout_completed(event_data, commit=commit)
-        
-        elif event_type == 'customer.subscription.created':
-            user = self._handle_subscription_created(event_data, commit=commit)
-        
-        elif event_type == 'customer.subscription.updated':
-            user = self._handle_subscription_updated(event_data, commit=commit)
-        
-        elif event_type == 'customer.subscription.deleted':
-            user = self._handle_subscription_deleted(event_data, commit=commit)
-        
-        elif event_type == 'invoice.payment_succeeded':
-            user = self._handle_invoice_paid(event_data, commit=commit)
-        
-        elif event_type == 'invoice.payment_failed':
-            user = self._handle_invoice_failed(event_data, commit=commit)
-        
-        else:
+        handler = self._default_handlers.get(event_type)
+        if handler is None:
             logger.info(f"No default handler for event type: {event_type}")
+            return None
         
-        return user
+        return handler(event_data, commit=commit)
     
-    def _handle_checkout_completed(self, session: Dict[str, Any], commit: bool = False) -> Optional[Any]:
+    def _handle_checkout_completed(self, session: Dict[str, Any], commit: bool = False,
+                                   prefetched_subscription: Optional[Any] = None) -> Optional[Any]:
         """
         Handle checkout.session.completed event.
         
         Args:
             commit: Whether to commit (False when part of larger transaction)
+            prefetched_subscription: The session's subscription, if already retrieved
             
         Returns:
             User object if found
         """
         customer_id = session.get('customer')
-        subscription_id = session.get('subscription')
+        subscription = session.get('subscription')
         user = None
         
-        if subscription_id:
-            # Retrieve full subscription data
-            subscription = stripe.Subscription.retrieve(subscription_id)
-            
-            # Find user by customer ID
-            user = self.user_model.query.filter_by(stripe_customer_id=customer_id).first()
+        if subscription:
+            # Find user by customer ID before calling Stripe
+            user = self._get_user_by_customer(customer_id)
             if user:
+                # Use the subscription if it was prefetched or is already expanded
+                # in the payload, otherwise retrieve full subscription data
+                if prefetched_subscription is not None:
+                    subscription = prefetched_subscription
+                elif isinstance(subscription, str):
+                    subscription = stripe.Subscription.retrieve(subscription)
                 self.subscription_manager.update_user_subscription(user.id, subscription, commit=commit)
         
         return user
@@ -278,7 +836,7 @@ class WebhookManager:
         customer_id = subscription.get('customer')
         
         # Find user by customer ID
-        user = self.user_model.query.filter_by(stripe_customer_id=customer_id).first()
+        user = self._get_user_by_customer(customer_id)
         if user:
             self.subscription_manager.update_user_subscription(user.id, subscription, commit=commit)
         
@@ -297,7 +855,7 @@ class WebhookManager:
         customer_id = subscription.get('customer')
         
         # Find user by customer ID
-        user = self.user_model.query.filter_by(stripe_customer_id=customer_id).first()
+        user = self._get_user_by_customer(customer_id)
         if user:
             self.subscription_manager.update_user_subscription(user.id, subscription, commit=commit)
         
@@ -316,7 +874,7 @@ class WebhookManager:
         customer_id = subscription.get('customer')
         
         # Find user by customer ID
-        user = self.user_model.query.filter_by(stripe_customer_id=customer_id).first()
+        user = self._get_user_by_customer(customer_id)
         if user:
             user.plan_status = 'canceled'
             user.stripe_subscription_id = None
@@ -336,7 +894,7 @@ class WebhookManager:
             User object if found
         """
         customer_id = invoice.get('customer')
-        user = self.user_model.query.filter_by(stripe_customer_id=customer_id).first() if customer_id else None
+        user = self._get_user_by_customer(customer_id)
         logger.info(f"Invoice {invoice['id']} paid successfully")
         return user
     
@@ -351,7 +909,7 @@ class WebhookManager:
             User object if found
         """
         customer_id = invoice.get('customer')
-        user = self.user_model.query.filter_by(stripe_customer_id=customer_id).first() if customer_id else None
+        user = self._get_user_by_customer(customer_id)
         logger.warning(f"Invoice {invoice['id']} payment failed")
         return user
 
@@ -0,0 +1,350 @@
+"""
+flask_headless_payments.managers.webhook_processor
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Background processing of recorded webhook events.
+"""
+
+import os
+import queue
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, List
+
+from flask_headless_payments.utils.clock import utcnow
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+# Rows whose retry state is remembered; the oldest are forgotten beyond this
+_MAX_TRACKED_ROWS = 1000
+
+
+class WebhookProcessor:
+    """
+    Drains recorded webhook events on a pool of worker threads.
+    
+    The webhook route only verifies and persists the event, then hands the
+    row id to this processor so Stripe gets its 200 without waiting on
+    handler DB writes or Stripe API calls.
+    
+    Each worker drains up to batch_size queued events at a time so their
+    users can be loaded in one query.
+    
+    Since Stripe has already been acknowledged, it will not re-deliver an
+    event whose handler fails here. A sweeper thread therefore re-queues
+    recorded events that failed or were left unprocessed (e.g. queued by a
+    process that exited) every redrive_interval seconds, up to max_retries
+    times per event. Retry counts are kept per process for the most recent
+    rows only, so a restart or heavy churn can grant a few extra retries.
+    Worker threads are restarted in a forked child (e.g. gunicorn --preload)
+    on first use.
+    
+    Workers lease each row when they take it off the queue, so a row that
+    another process has since re-claimed is skipped instead of processed twice.
+    
+    Usage:
+        processor = WebhookProcessor(webhook_manager, max_queue_size=1000, workers=4)
+        processor.start(app)
+        processor.enqueue(webhook_event_id)
+    """
+    
+    def __init__(self, webhook_manager, max_queue_size: int = 1000, workers: int = 4,
+                 batch_size: int = 50, redrive_interval: float = 60, max_retries: int = 5):
+        """
+        Initialize webhook processor.
+        
+        Args:
+            webhook_manager: WebhookManager instance
+            max_queue_size: Maximum number of events waiting for a worker
+            workers: Number of worker threads
+            batch_size: Maximum number of events a worker takes per batch
+            redrive_interval: Seconds between sweeps for failed or stale events (0 disables)
+            max_retries: Maximum number of times a single event is re-queued by the sweeper
+        """
+        self.webhook_manager = webhook_manager
+        self.max_queue_size = max_queue_size
+        self.workers = workers
+        self.batch_size = max(1, batch_size)
+        self.redrive_interval = redrive_interval
+        self.max_retries = max_retries
+        self.app = None
+        
+        self._pid = None
+        self._fork_lock = threading.Lock()
+        self._exit_hook_registered = False
+        self._reset()
+    
+    def _reset(self):
+        """Create fresh queue, thread and counter state (also used after a fork)."""
+        self._queue = queue.Queue(maxsize=self.max_queue_size)
+        self._threads = []
+        self._sweeper = None
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._pending = set()  # Row ids queued or being processed by this process
+        self._retries = OrderedDict()  # Row id -> times re-queued by the sweeper
+        self._exhausted = OrderedDict()  # Row ids out of retries, left for manual inspection
+        self._stats = {
+            'enqueued': 0,
+            'processed': 0,
+            'failed': 0,
+            'dropped': 0,
+            'redriven': 0,
+        }
+    
+    def start(self, app):
+        """
+        Start worker threads and the sweeper.
+        
+        Args:
+            app: Flask application (workers push its app context per event)
+        """
+        if self._threads:
+            return
+        
+        self.app = app
+        self._pid = os.getpid()
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._worker_loop,
+                name=f'paymentsvc-webhook-{i}',
+                daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        
+        if self.redrive_interval and self.redrive_interval > 0:
+            self._sweeper = threading.Thread(
+                target=self._sweep_loop,
+                name='paymentsvc-webhook-sweeper',
+                daemon=True
+            )
+            self._sweeper.start()
+        
+        if not self._exit_hook_registered:
+            # Drain what is already queued before the interpreter kills the daemon threads
+            atexit.register(self.shutdown)
+            self._exit_hook_registered = True
+        
+        logger.info(f"Webhook processor started with {self.workers} workers")
+    
+    def shutdown(self, wait: bool = True, timeout: float = 30):
+        """
+        Stop worker threads after the queue is drained.
+        
+        Events still queued when the timeout expires stay recorded as
+        unprocessed and are picked up by the next sweep.
+        
+        Args:
+            wait: Block until all workers have exited
+            timeout: Maximum seconds to wait for the queue to drain
+        """
+        if not self._threads or self._pid != os.getpid():
+            return
+        
+        self._stopping.set()
+        for _ in self._threads:
+            try:
+                self._queue.put(_STOP, timeout=timeout)
+            except queue.Full:
+                break
+        
+        if wait:
+            for thread in self._threads:
+                thread.join(timeout)
+        
+        self._threads = []
+        logger.info("Webhook processor stopped")
+    
+    def enqueue(self, webhook_event_id: int) -> bool:
+        """
+        Queue a recorded webhook event for processing.
+        
+        Args:
+            webhook_event_id: Primary key of the recorded WebhookEvent row
+        
+        Returns:
+            bool: True if queued, False if the queue is full or not running
+        """
+        self._check_fork()
+        if not self._threads:
+            return False
+        
+        with self._lock:
+            # Before put(): a worker may finish the event before we get the lock back
+            self._pending.add(webhook_event_id)
+        
+        try:
+            self._queue.put_nowait((webhook_event_id, utcnow()))
+        except queue.Full:
+            with self._lock:
+                self._pending.discard(webhook_event_id)
+            self.record_dropped()
+            logger.warning(f"Webhook queue full, event row {webhook_event_id} not queued")
+            return False
+        
+        self._increment('enqueued')
+        return True
+    
+    def is_full(self) -> bool:
+        """Check whether a new event would be rejected by enqueue()."""
+        self._check_fork()
+        return not self._threads or self._queue.full()
+    
+    def record_dropped(self):
+        """Count an event that was processed in the request instead of queued."""
+        self._increment('dropped')
+    
+    def redrive(self) -> int:
+        """
+        Re-queue recorded events that failed or were left unprocessed.
+        
+        Called by the sweeper thread; safe to call directly (e.g. from a
+        scheduled job) while the processor is running.
+        
+        Returns:
+            int: Number of events re-queued
+        """
+        if not self._threads:
+            return 0
+        
+        with self._lock:
+            exclude = self._pending.union(self._exhausted)
+        
+        free_slots = self.max_queue_size - self._queue.qsize() if self.max_queue_size > 0 else self.batch_size
+        limit = min(self.batch_size, free_slots)
+        if limit <= 0:
+            return 0
+        
+        with self.app.app_context():
+            claimed = self.webhook_manager.claim_stale_events(limit=limit, exclude=exclude)
+        
+        redriven = 0
+        for webhook_event_id in claimed:
+            if not self.enqueue(webhook_event_id):
+                # Left claimed; it goes stale again and the next sweep retries it
+                break
+            
+            redriven += 1
+            with self._lock:
+                self._stats['redriven'] += 1
+                retries = self._retries.pop(webhook_event_id, 0) + 1
+                if retries < self.max_retries:
+                    self._track(self._retries, webhook_event_id, retries)
+                else:
+                    self._track(self._exhausted, webhook_event_id, True)
+                    logger.error(f"Webhook event row {webhook_event_id} reached {retries} retries; "
+                                 f"it will not be re-queued again")
+        
+        return redriven
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Get queue metrics.
+        
+        Returns:
+            dict: Queue depth, live worker count and event counters
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['exhausted'] = len(self._exhausted)
+        
+        stats.update({
+            'queue_depth': self._queue.qsize(),
+            'max_queue_size': self.max_queue_size,
+            # Threads don't survive a fork, so count the ones actually running
+            'workers': sum(1 for thread in self._threads if thread.is_alive()),
+        })
+        return stats
+    
+    def _check_fork(self):
+        """Restart the workers in a forked child; the parent's threads don't exist there."""
+        if self._pid is None or self._pid == os.getpid():
+            return
+        
+        with self._fork_lock:
+            if self._pid == os.getpid():
+                return
+            
+            logger.info(f"Webhook processor restarting workers after fork (pid {os.getpid()})")
+            self._reset()
+            self.start(self.app)
+    
+    @staticmethod
+    def _track(rows: OrderedDict, webhook_event_id: int, value: Any):
+        """Remember per-row state, forgetting the oldest rows beyond _MAX_TRACKED_ROWS."""
+        rows[webhook_event_id] = value
+        while len(rows) > _MAX_TRACKED_ROWS:
+            rows.popitem(last=False)
+    
+    def _increment(self, key: str):
+        with self._lock:
+            self._stats[key] += 1
+    
+    def _next_batch(self):
+        """
+        Block for one queued event, then take whatever else is already waiting.
+        
+        Returns:
+            tuple: (list of (row id, queued at) pairs, whether a stop sentinel was seen)
+        """
+        batch = []
+        item = self._queue.get()
+        
+        while True:
+            if item is _STOP:
+                self._queue.task_done()
+                return batch, True
+            
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                return batch, False
+            
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return batch, False
+    
+    def _worker_loop(self):
+        """Process queued events until a stop sentinel is received."""
+        while True:
+            batch, stop = self._next_batch()
+            
+            if batch:
+                webhook_event_ids = [webhook_event_id for webhook_event_id, _ in batch]
+                try:
+                    with self.app.app_context():
+                        results = self.webhook_manager.process_recorded_events(
+                            webhook_event_ids, queued_at=dict(batch)
+                        )
+                    self._record_results(webhook_event_ids, results)
+                except Exception as e:
+                    self._record_results(webhook_event_ids, [False] * len(batch))
+                    logger.error(f"Webhook worker failed on event rows {webhook_event_ids}: {e}")
+                finally:
+                    for _ in batch:
+                        self._queue.task_done()
+            
+            if stop:
+                return
+    
+    def _record_results(self, batch: List[int], results: List[bool]):
+        with self._lock:
+            for webhook_event_id, success in zip(batch, results):
+                self._pending.discard(webhook_event_id)
+                self._stats['processed' if success else 'failed'] += 1
+                if success:
+                    self._retries.pop(webhook_event_id, None)
+                    self._exhausted.pop(webhook_event_id, None)
+    
+    def _sweep_loop(self):
+        """Periodically re-queue failed or stale events until shutdown."""
+        while not self._stopping.wait(self.redrive_interval):
+            try:
+                self.redrive()
+            except Exception as e:
+                logger.error(f"Webhook sweep failed: {e}")
@@ -8,10 +8,13 @@ Uses SQLAlchemy's declared_attr pattern so columns are automatically
 created when the mixin is inherited - no manual column definition needed.
 """
 
-from datetime import datetime
 from sqlalchemy import Column, String, DateTime, Boolean, JSON
 from sqlalchemy.orm import declared_attr
 
+from flask_headless_payments.utils.clock import utcnow
+
+_ACTIVE_STATUSES = frozenset(('active', 'trialing'))
+
 
 class SubscriptionMixin:
     """
@@ -25,6 +28,11 @@ class SubscriptionMixin:
             id = db.Column(db.Integer, primary_key=True)
             email = db.Column(db.String(255), unique=True)
             # subscription columns are automatically added!
+    
+    If you declare the Stripe columns yourself instead, keep them indexed:
+    webhooks look users up by stripe_customer_id on every event.
+        stripe_customer_id = db.Column(db.String(255), unique=True, index=True)
+        stripe_subscription_id = db.Column(db.String(255), index=True)
     """
     
     # Stripe customer fields - using declared_attr for proper column creation
@@ -72,15 +80,13 @@ class SubscriptionMixin:
     
     def is_subscribed(self):
         """Check if user has an active subscription."""
-        if not self.plan_status:
-            return False
-        return self.plan_status in ['active', 'trialing']
+        return self.plan_status in _ACTIVE_STATUSES
     
-    def is_on_trial(self):
+    def is_on_trial(self, _now=None):
         """Check if user is on trial."""
         if not self.trial_end:
             return False
-        return datetime.utcnow() < self.trial_end and self.plan_status == 'trialing'
+        return (_now or utcnow()) < self.trial_end and self.plan_status == 'trialing'
     
     def has_plan(self, plan_name):
         """Check if user has a specific plan."""
@@ -94,23 +100,35 @@ class SubscriptionMixin:
             return False
         return self.plan_name in plan_names
     
-    def subscription_active(self):
+    def subscription_active(self, _now=None):
         """Check if subscription is currently active (not expired)."""
         if not self.is_subscribed():
             return False
         if not self.current_period_end:
             return False
-        return datetime.utcnow() < self.current_period_end
+        return (_now or utcnow()) < self.current_period_end
     
-    def days_until_renewal(self):
+    def days_until_renewal(self, _now=None):
         """Get days until subscription renewal."""
         if not self.current_period_end:
             return None
-        delta = self.current_period_end - datetime.utcnow()
+        delta = self.current_period_end - (_now or utcnow())
         return max(0, delta.days)
     
+    def _check_at(self, name, now):
+        """
+        Call a time-based check with a shared timestamp.
+        
+        Subclass overrides may not accept _now, so they are called without it.
+        """
+        if getattr(type(self), name) is getattr(SubscriptionMixin, name):
+            return getattr(self, name)(_now=now)
+        return getattr(self, name)()
+    
     def to_subscription_dict(self):
         """Convert subscription info to dictionary."""
+        now = utcnow()
+        
         return {
             'stripe_customer_id': self.stripe_customer_id,
             'stripe_subscription_id': self.stripe_subscription_id,
@@ -122,8 +140,8 @@ class SubscriptionMixin:
             'trial_start': self.trial_start.isoformat() if self.trial_start else None,
             'trial_end': self.trial_end.isoformat() if self.trial_end else None,
             'is_subscribed': self.is_subscribed(),
-            'is_on_trial': self.is_on_trial(),
-            'days_until_renewal': self.days_until_renewal(),
+            'is_on_trial': self._check_at('is_on_trial', now),
+            'days_until_renewal': self._check_at('days_until_renewal', now),
         }
     
     def __repr__(self):
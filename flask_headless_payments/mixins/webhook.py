@@ -22,6 +22,21 @@ class WebhookEventMixin:
     
     IMPORTANT: The column is named 'data' - if you override, keep this name
     as the webhook_manager expects it.
+    
+    IMPORTANT: stripe_event_id must stay unique. The webhook_manager inserts
+    events with ON CONFLICT DO NOTHING on this column to skip Stripe retries
+    of events that were already processed. If you override the column, keep
+    unique=True (or add UniqueConstraint('stripe_event_id') to __table_args__).
+    Without it the manager looks the event up before inserting, which does
+    not stop two concurrent deliveries of the same event.
+    
+    The event payload is encoded once, when the row is inserted, using the
+    engine's JSON serializer. Apps that want a faster codec can set it on the
+    engine, e.g.:
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'json_serializer': lambda obj: orjson.dumps(obj).decode(),
+            'json_deserializer': orjson.loads,
+        }
     """
     
     # Core fields - using declared_attr for proper column creation
@@ -5,7 +5,7 @@ flask_headless_payments.routes.payments
 Payment API routes.
 """
 
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, request, jsonify, current_app, g
 from flask_jwt_extended import jwt_required, get_jwt_identity
 import stripe
 import logging
@@ -14,6 +14,62 @@ import os
 logger = logging.getLogger(__name__)
 
 
+def _current_user(user_model):
+    """
+    Resolve the JWT identity to a user, once per request.
+    
+    Handles both email (string) and ID (int) as JWT identity. The result is
+    cached on flask.g so later lookups in the same request don't reload it.
+    
+    Args:
+        user_model: User model class
+    
+    Returns:
+        User object or None if not found
+    """
+    cached = g.get('_paymentsvc_user')
+    if cached is not None and cached[0] is user_model:
+        return cached[1]
+    
+    identity = get_jwt_identity()
+    if isinstance(identity, str) and '@' in identity:
+        user = user_model.query.filter_by(email=identity).first()
+    else:
+        user = user_model.query.get(identity)
+    
+    g._paymentsvc_user = (user_model, user)
+    return user
+
+
+def _read_body(max_bytes):
+    """
+    Read the raw request body, giving up as soon as it exceeds max_bytes.
+    
+    A Content-Length over the limit is rejected without reading anything;
+    bodies without one are read in chunks and stop one byte past the limit.
+    
+    Args:
+        max_bytes: Maximum accepted body size
+    
+    Returns:
+        bytes: Request body, or None if it is larger than max_bytes
+    """
+    content_length = request.content_length
+    if content_length is not None and content_length > max_bytes:
+        return None
+    
+    body = bytearray()
+    while len(body) <= max_bytes:
+        chunk = request.stream.read(min(65536, max_bytes + 1 - len(body)))
+        if not chunk:
+            break
+        body += chunk
+    
+    if len(body) > max_bytes:
+        return None
+    return bytes(body)
+
+
 def create_payment_blueprint(
     user_model,
     customer_model,
@@ -25,7 +81,8 @@ def create_payment_blueprint(
     plan_manager,
     config,
     blueprint_name='paymentsvc',
-    webhook_secret=None
+    webhook_secret=None,
+    webhook_processor=None
 ):
     """
     Create payment blueprint with all routes.
@@ -41,6 +98,10 @@ def create_payment_blueprint(
         plan_manager: PlanManager instance
         config: App configuration
         blueprint_name: Blueprint name (default: 'paymentsvc')
+        webhook_secret: Instance-level Stripe webhook secret (optional)
+        webhook_processor: WebhookProcessor instance (optional). When set, webhook
+            events are recorded and acknowledged immediately, then processed in
+            the background. When None, events are processed inside the request.
     
     Returns:
         Blueprint: Configured payment blueprint
@@ -51,6 +112,16 @@ def create_payment_blueprint(
     # Configure Stripe
     stripe.api_key = config.get('STRIPE_API_KEY')
     
+    max_webhook_bytes = config.get('PAYMENTSVC_WEBHOOK_MAX_BYTES', 256 * 1024)
+    
+    # Same SQLAlchemy instance the managers write through
+    db = subscription_manager.db
+    
+    # The user model is fixed for this blueprint, so check its capabilities once
+    supports_subscription_dict = callable(getattr(user_model, 'to_subscription_dict', None))
+    has_customer_column = hasattr(user_model, 'stripe_customer_id')
+    has_subscription_column = hasattr(user_model, 'stripe_subscription_id')
+    
     @bp.route('/plans', methods=['GET'])
     def get_plans():
         """Get all available plans."""
@@ -65,20 +136,15 @@ def create_payment_blueprint(
     @jwt_required()
     def get_subscription():
         """Get current user's subscription."""
+        if not supports_subscription_dict:
+            return jsonify({'error': 'User model does not support subscriptions'}), 400
+        
         try:
-            identity = get_jwt_identity()
-            # Handle both email (string) and ID (int) as JWT identity
-            if isinstance(identity, str) and '@' in identity:
-                user = user_model.query.filter_by(email=identity).first()
-            else:
-                user = user_model.query.get(identity)
+            user = _current_user(user_model)
             
             if not user:
                 return jsonify({'error': 'User not found'}), 404
             
-            if not hasattr(user, 'to_subscription_dict'):
-                return jsonify({'error': 'User model does not support subscriptions'}), 400
-            
             subscription_info = user.to_subscription_dict()
             return jsonify({'subscription': subscription_info}), 200
             
@@ -91,12 +157,7 @@ def create_payment_blueprint(
     def create_checkout():
         """Create a Stripe Checkout session."""
         try:
-            identity = get_jwt_identity()
-            # Handle both email (string) and ID (int) as JWT identity
-            if isinstance(identity, str) and '@' in identity:
-                user = user_model.query.filter_by(email=identity).first()
-            else:
-                user = user_model.query.get(identity)
+            user = _current_user(user_model)
             
             if not user:
                 return jsonify({'error': 'User not found'}), 404
@@ -123,11 +184,10 @@ def create_payment_blueprint(
                 name=getattr(user, 'first_name', None)
             )
             
-            # Update user with customer ID if not set
-            if not hasattr(user, 'stripe_customer_id') or not user.stripe_customer_id:
+            # Update user with customer ID if not set (new customers are
+            # already linked in the same commit as their Customer row)
+            if has_customer_column and not user.stripe_customer_id:
                 user.stripe_customer_id = customer_id
-                from flask_headless_payments.extensions import get_db
-                db = get_db()
                 db.session.commit()
             
             # Get trial days
@@ -190,11 +250,7 @@ def create_payment_blueprint(
         - Returns "active"/"trialing" once subscription is confirmed
         """
         try:
-            identity = get_jwt_identity()
-            if isinstance(identity, str) and '@' in identity:
-                user = user_model.query.filter_by(email=identity).first()
-            else:
-                user = user_model.query.get(identity)
+            user = _current_user(user_model)
             
             if not user:
                 return jsonify({'error': 'User not found'}), 404
@@ -203,7 +259,7 @@ def create_payment_blueprint(
             
             # Check if we have subscription data
             has_subscription = (
-                hasattr(user, 'stripe_subscription_id') and 
+                has_subscription_column and
                 user.stripe_subscription_id is not None
             )
             
@@ -277,18 +333,13 @@ def create_payment_blueprint(
     def create_portal():
         """Create a Stripe Customer Portal session."""
         try:
-            identity = get_jwt_identity()
-            # Handle both email (string) and ID (int) as JWT identity
-            if isinstance(identity, str) and '@' in identity:
-                user = user_model.query.filter_by(email=identity).first()
-            else:
-                user = user_model.query.get(identity)
+            user = _current_user(user_model)
             
             if not user:
                 return jsonify({'error': 'User not found'}), 404
             
             # Check if user has customer ID
-            if not hasattr(user, 'stripe_customer_id') or not user.stripe_customer_id:
+            if not has_customer_column or not user.stripe_customer_id:
                 return jsonify({'error': 'No active subscription found'}), 400
             
             # Create portal session
@@ -310,17 +361,12 @@ def create_payment_blueprint(
     def cancel_subscription():
         """Cancel user's subscription."""
         try:
-            identity = get_jwt_identity()
-            # Handle both email (string) and ID (int) as JWT identity
-            if isinstance(identity, str) and '@' in identity:
-                user = user_model.query.filter_by(email=identity).first()
-            else:
-                user = user_model.query.get(identity)
+            user = _current_user(user_model)
             
             if not user:
                 return jsonify({'error': 'User not found'}), 404
             
-            if not hasattr(user, 'stripe_subscription_id') or not user.stripe_subscription_id:
+            if not has_subscription_column or not user.stripe_subscription_id:
                 return jsonify({'error': 'No active subscription found'}), 400
             
             data = request.get_json() or {}
@@ -352,17 +398,12 @@ def create_payment_blueprint(
     def upgrade_plan():
         """Upgrade/downgrade subscription plan."""
         try:
-            identity = get_jwt_identity()
-            # Handle both email (string) and ID (int) as JWT identity
-            if isinstance(identity, str) and '@' in identity:
-                user = user_model.query.filter_by(email=identity).first()
-            else:
-                user = user_model.query.get(identity)
+            user = _current_user(user_model)
             
             if not user:
                 return jsonify({'error': 'User not found'}), 404
             
-            if not hasattr(user, 'stripe_subscription_id') or not user.stripe_subscription_id:
+            if not has_subscription_column or not user.stripe_subscription_id:
                 return jsonify({'error': 'No active subscription found'}), 400
             
             data = request.get_json()
@@ -404,10 +445,13 @@ def create_payment_blueprint(
     
     @bp.route('/webhook', methods=['POST'])
     def webhook():
-        """Handle Stripe webhook events."""
-        payload = request.data
-        sig_header = request.headers.get('Stripe-Signature')
+        """
+        Handle Stripe webhook events.
         
+        Order: secret lookup -> signature header -> read capped body and verify ->
+        record/dispatch. Requests that can't be valid are rejected before the
+        body is read or the database is touched.
+        """
         # Smart fallback chain for webhook secret:
         # 1. Instance-level (for multi-app monorepos): webhook_secret parameter
         # 2. App-specific env var from config: STRIPE_WEBHOOK_SECRET_{BLUEPRINT_NAME}
@@ -428,19 +472,67 @@ def create_payment_blueprint(
             logger.error(f"Webhook secret not configured. Tried: webhook_secret param, config[{app_specific_key}], os.environ[{app_specific_key}], config[STRIPE_WEBHOOK_SECRET], os.environ[STRIPE_WEBHOOK_SECRET]")
             return jsonify({'error': 'Webhook not configured'}), 500
         
-        # Verify webhook signature
+        sig_header = request.headers.get('Stripe-Signature')
+        if not sig_header:
+            return jsonify({'error': 'Invalid signature'}), 400
+        
+        payload = _read_body(max_webhook_bytes)
+        if payload is None:
+            logger.warning(f"Rejected webhook body larger than {max_webhook_bytes} bytes")
+            return jsonify({'error': 'Payload too large'}), 413
+        
+        # Verify webhook signature (Stripe compares HMACs in constant time)
         event = webhook_manager.verify_webhook(payload, sig_header, secret)
         
         if not event:
             return jsonify({'error': 'Invalid signature'}), 400
         
-        # Process event
-        success = webhook_manager.process_event(event)
+        if webhook_manager.skips_persistence(event['type']):
+            # Log-only event type - nothing to store or queue
+            logger.info(f"Acknowledged event {event['id']} of type {event['type']} without storing it")
+            return jsonify({'status': 'success'}), 200
+        
+        if webhook_processor is None or webhook_processor.is_full():
+            if webhook_processor is not None:
+                # Queue full - process in the request (backpressure), one transaction
+                webhook_processor.record_dropped()
+            
+            # Process event
+            success = webhook_manager.process_event(event)
+            
+            if success:
+                return jsonify({'status': 'success'}), 200
+            else:
+                return jsonify({'error': 'Failed to process event'}), 500
         
-        if success:
+        # Persist the raw event, then acknowledge and process in the background
+        try:
+            webhook_event_id = webhook_manager.record_event(event)
+        except Exception as e:
+            logger.error(f"Failed to record event {event['id']}: {e}")
+            return jsonify({'error': 'Failed to record event'}), 500
+        
+        if webhook_event_id is None:
+            # Stripe re-delivered an event we already have
+            return jsonify({'status': 'duplicate'}), 200
+        
+        if not webhook_processor.enqueue(webhook_event_id):
+            # Queue filled up after the check above - process the recorded row here
+            if not webhook_manager.process_recorded_event(webhook_event_id):
+                return jsonify({'error': 'Failed to process event'}), 500
             return jsonify({'status': 'success'}), 200
-        else:
-            return jsonify({'error': 'Failed to process event'}), 500
+        
+        return jsonify({'status': 'queued'}), 200
+    
+    if config.get('PAYMENTSVC_WEBHOOK_METRICS', False):
+        # Unauthenticated - only enable behind a private network or proxy rule
+        @bp.route('/webhook/metrics', methods=['GET'])
+        def webhook_metrics():
+            """Webhook queue metrics (queue depth, dropped events, counters)."""
+            if webhook_processor is None:
+                return jsonify({'async': False}), 200
+            
+            return jsonify({'async': True, **webhook_processor.get_stats()}), 200
     
     return bp
 
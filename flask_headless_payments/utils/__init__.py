@@ -9,11 +9,13 @@ from .retry import retry_with_backoff
 from .idempotency import IdempotencyManager
 from .validation import validate_request
 from .monitoring import request_id_middleware
+from .cache import TTLCache
 
 __all__ = [
     'retry_with_backoff',
     'IdempotencyManager',
     'validate_request',
-    'request_id_middleware'
+    'request_id_middleware',
+    'TTLCache'
 ]
 
@@ -0,0 +1,90 @@
+"""
+flask_headless_payments.utils.cache
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Small in-process caches.
+"""
+
+import time
+import threading
+from typing import Any, Hashable, Optional
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe in-memory cache with per-entry expiry and a size cap.
+    
+    When full, the oldest entry is evicted. Meant for short-lived lookups
+    inside one process - use Redis if values must be shared across workers.
+    
+    Usage:
+        cache = TTLCache(maxsize=10000, ttl=30)
+        cache.set('cus_123', 42)
+        user_id = cache.get('cus_123')
+    """
+    
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        """
+        Initialize cache.
+        
+        Args:
+            maxsize: Maximum number of entries
+            ttl: Seconds an entry stays valid
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = {}
+        self._lock = threading.Lock()
+    
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Get a cached value.
+        
+        Args:
+            key: Cache key
+            default: Returned when the key is missing or expired
+        
+        Returns:
+            Cached value or default
+        """
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            return value
+    
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """
+        Store a value.
+        
+        Args:
+            key: Cache key
+            value: Value to cache
+            ttl: Override the default TTL for this entry (optional)
+        """
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data.pop(key, None)
+            while len(self._data) >= self.maxsize:
+                del self._data[next(iter(self._data))]
+            self._data[key] = (expires_at, value)
+    
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Remove a key and return its value (expired or not)."""
+        with self._lock:
+            entry = self._data.pop(key, _MISSING)
+        return default if entry is _MISSING else entry[1]
+    
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._data.clear()
+    
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,18 @@
+"""
+flask_headless_payments.utils.clock
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Timestamp helpers.
+"""
+
+from datetime import datetime, timezone
+
+
+def utcnow() -> datetime:
+    """
+    Current UTC time as a naive datetime.
+    
+    Replacement for the deprecated datetime.utcnow(). Stays naive because
+    the DateTime columns store naive UTC values and are compared against it.
+    """
+    return datetime.now(timezone.utc).replace(tzinfo=None)
@@ -0,0 +1,38 @@
+"""
+flask_headless_payments.utils.schema
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Model schema introspection helpers.
+"""
+
+from sqlalchemy import UniqueConstraint
+
+
+def has_index(table, column_name: str, unique: bool = False) -> bool:
+    """
+    Check whether a column can be looked up via an index.
+    
+    Args:
+        table: SQLAlchemy Table
+        column_name: Column to check
+        unique: Require a unique single-column index or constraint
+    
+    Returns:
+        bool: True if the column is indexed (uniquely, if requested)
+    """
+    column = table.columns[column_name]
+    if column.unique or column.primary_key or (column.index and not unique):
+        return True
+    
+    if any(isinstance(c, UniqueConstraint) and list(c.columns) == [column]
+           for c in table.constraints):
+        return True
+    
+    for index in table.indexes:
+        index_columns = list(index.columns)
+        if unique and index.unique and index_columns == [column]:
+            return True
+        if not unique and index_columns[:1] == [column]:
+            return True
+    
+    return False
@@ -1,65 +1,95 @@
 """
 Test application for flask-headless-payments
+
+Run with `python test_app.py` (FLASK_DEBUG=1 for the debugger, PORT to
+change the port). For benchmarking use a threaded gunicorn so slow Stripe
+calls overlap: `gunicorn -k gthread --threads 8 -w 2 'test_app:create_app()'`.
+`flask --app test_app run` finds create_app() on its own. There is no
+module-level app: importing only defines the model, create_app() builds
+and configures the app, starts PaymentSvc and prepares the database.
 """
 
-from flask import Flask
+from flask import Blueprint, Flask, Response, current_app
 from flask_sqlalchemy import SQLAlchemy
+from datetime import datetime
 import os
 import sys
 
-# Add package to path
-sys.path.insert(0, os.path.dirname(__file__))
-
-app = Flask(__name__)
+# Add package to path (once - the module may be imported more than once)
+_here = os.path.dirname(os.path.abspath(__file__))
+if _here not in sys.path:
+    sys.path.insert(0, _here)
 
-# Configuration
-app.config['SECRET_KEY'] = 'test-secret-key'
-app.config['JWT_SECRET_KEY'] = 'test-jwt-secret-key'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Bump when models change so the next start runs create_all() again
+SCHEMA_VERSION = 1
 
-# Stripe configuration (test mode)
-app.config['STRIPE_API_KEY'] = os.getenv('STRIPE_API_KEY', 'sk_test_dummy_key')
-app.config['STRIPE_WEBHOOK_SECRET'] = os.getenv('STRIPE_WEBHOOK_SECRET', 'whsec_dummy')
+# Use orjson for JSON responses when it is installed (same output, faster encoding)
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-# Initialize database
-db = SQLAlchemy(app)
+if orjson is not None:
+    from flask.json.provider import DefaultJSONProvider
+    
+    class OrjsonProvider(DefaultJSONProvider):
+        """Flask's default JSON provider, encoding with orjson."""
+        
+        # Sorted keys and Flask's datetime format, like the default provider
+        option = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        
+        def dumps(self, obj, **kwargs):
+            return orjson.dumps(obj, default=self.default, option=self.option).decode()
+        
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+        
+        def response(self, *args, **kwargs):
+            # Hand orjson's bytes straight to the response (no decode/encode round trip)
+            obj = self._prepare_response_obj(args, kwargs)
+            option = self.option | orjson.OPT_APPEND_NEWLINE
+            if (self.compact is None and self._app.debug) or self.compact is False:
+                option |= orjson.OPT_INDENT_2
+            return self._app.response_class(
+                orjson.dumps(obj, default=self.default, option=option),
+                mimetype=self.mimetype
+            )
+
+# Database (bound to the app in create_app())
+db = SQLAlchemy()
+
+from sqlalchemy import event, select, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+
+def _sqlite_pragmas(dbapi_conn, _):
+    """SQLite tuning: WAL lets readers run during webhook writes."""
+    cursor = dbapi_conn.cursor()
+    for pragma in ('journal_mode=WAL', 'synchronous=NORMAL', 'cache_size=-32000',
+                   'temp_store=MEMORY', 'mmap_size=268435456', 'busy_timeout=5000'):
+        cursor.execute(f'PRAGMA {pragma}')
+    cursor.close()
 
 # Create User model with SubscriptionMixin
 from flask_headless_payments import SubscriptionMixin
 
-class User(db.Model):
+class User(db.Model, SubscriptionMixin):
     __tablename__ = 'users'
+    __table_args__ = (
+        # Renewal/expiry sweeps filter by status and range over period or trial end
+        db.Index('ix_user_status_period', 'plan_status', 'current_period_end'),
+        db.Index('ix_user_trial_end', 'trial_end'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
-    email = db.Column(db.String(255), unique=True, nullable=False)
-    password_hash = db.Column(db.String(1024))
-    
-    # Add SubscriptionMixin fields
-    stripe_customer_id = db.Column(db.String(255), unique=True)
-    stripe_subscription_id = db.Column(db.String(255))
-    plan_name = db.Column(db.String(50))
-    plan_status = db.Column(db.String(50))
-    current_period_start = db.Column(db.DateTime)
-    current_period_end = db.Column(db.DateTime)
-    trial_start = db.Column(db.DateTime)
-    trial_end = db.Column(db.DateTime)
-    cancel_at_period_end = db.Column(db.Boolean, default=False)
+    email = db.Column(db.String(190), unique=True, nullable=False, index=True)  # utf8mb4 index limit
+    password_hash = db.Column(db.String(255))
     
-    created_at = db.Column(db.DateTime, default=db.func.now())
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
 
-# Add mixin methods
-for attr_name in dir(SubscriptionMixin):
-    if not attr_name.startswith('_') and callable(getattr(SubscriptionMixin, attr_name)):
-        if not hasattr(User, attr_name):
-            setattr(User, attr_name, getattr(SubscriptionMixin, attr_name))
-
-# Initialize JWT
 from flask_jwt_extended import JWTManager, create_access_token
-jwt = JWTManager(app)
-
-# Initialize PaymentSvc
 from flask_headless_payments import PaymentSvc
+from flask_headless_payments.utils import TTLCache
 
 plans = {
     'free': {
@@ -82,63 +112,144 @@ plans = {
     }
 }
 
-payments = PaymentSvc(app, user_model=User, plans=plans)
+# Test routes
+routes = Blueprint('test_app', __name__)
+
+_INDEX = {
+    'message': 'Flask-Headless-Payments Test Server',
+    'version': '0.1.0',
+    'endpoints': {
+        'health': '/health',
+        'plans': '/api/payments/plans',
+        'auth': '/test/login',
+        'docs': 'See README.md'
+    }
+}
+
 
-# Create tables
-with app.app_context():
-    db.create_all()
+def create_app():
+    """Build the test app: config, JWT, PaymentSvc (webhook workers, Stripe) and the database."""
+    app = Flask(__name__)
+    
+    # Configuration
+    app.config['SECRET_KEY'] = 'test-secret-key'
+    app.config['JWT_SECRET_KEY'] = 'test-jwt-secret-key'
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Keep enough pooled connections for request threads plus webhook workers,
+    # so overflow connections aren't reopened (and re-PRAGMA'd) under load
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_size': 10}
+    # Tables are created below, only when the schema version changes
+    app.config['PAYMENTSVC_CREATE_TABLES'] = False
+    
+    # Stripe configuration (test mode)
+    app.config['STRIPE_API_KEY'] = os.getenv('STRIPE_API_KEY', 'sk_test_dummy_key')
+    app.config['STRIPE_WEBHOOK_SECRET'] = os.getenv('STRIPE_WEBHOOK_SECRET', 'whsec_dummy')
+    
+    if orjson is not None:
+        app.json = OrjsonProvider(app)
     
-    # Create a test user if doesn't exist
-    test_user = User.query.filter_by(email='test@example.com').first()
-    if not test_user:
-        test_user = User(email='test@example.com', password_hash='dummy')
-        db.session.add(test_user)
+    # Initialize database
+    db.init_app(app)
+    with app.app_context():
+        event.listen(db.engine, 'connect', _sqlite_pragmas)
+    
+    # Initialize JWT
+    JWTManager(app)
+    
+    # Initialize PaymentSvc
+    PaymentSvc(app, user_model=User, plans=plans)
+    
+    # The index payload never changes, so encode it once
+    app.extensions['test_app_index'] = app.json.dumps(_INDEX).encode()
+    app.register_blueprint(routes)
+    
+    # Create tables
+    with app.app_context():
+        # PRAGMA user_version is a free header read; create_all() inspects every table
+        if db.session.execute(text('PRAGMA user_version')).scalar() < SCHEMA_VERSION:
+            db.create_all()
+            db.session.execute(text(f'PRAGMA user_version={SCHEMA_VERSION}'))
+            db.session.commit()
+        
+        # Create a test user if doesn't exist (one INSERT OR IGNORE statement)
+        test_user_id = db.session.execute(
+            sqlite_insert(User)
+            .values(email='test@example.com', password_hash='dummy')
+            .on_conflict_do_nothing(index_elements=['email'])
+            .returning(User.id)
+        ).scalar()
         db.session.commit()
-        print(f"Created test user with ID: {test_user.id}")
+        if test_user_id is not None:
+            print(f"Created test user with ID: {test_user_id}")
+    
+    return app
 
-# Test routes
-@app.route('/')
+
+@routes.route('/')
 def index():
-    return {
-        'message': 'Flask-Headless-Payments Test Server',
-        'version': '0.1.0',
-        'endpoints': {
-            'health': '/health',
-            'plans': '/api/payments/plans',
-            'auth': '/test/login',
-            'docs': 'See README.md'
-        }
-    }
+    return Response(current_app.extensions['test_app_index'], mimetype='application/json')
+
+# Tokens live 15 minutes (JWT default); reuse one for up to 4 minutes
+_login_cache = TTLCache(maxsize=16, ttl=240)
 
-@app.route('/test/login', methods=['POST'])
+@routes.route('/test/login', methods=['POST'])
 def test_login():
     """Create a test JWT token"""
-    user = User.query.filter_by(email='test@example.com').first()
+    cached = _login_cache.get('test@example.com')
+    if cached:
+        return cached
+    
+    # Only id and email are needed - skip building a full User instance
+    user = db.session.execute(
+        select(User.id, User.email).where(User.email == 'test@example.com')
+    ).first()
     if user:
-        access_token = create_access_token(identity=user.id)
-        return {
+        # JWT subjects must be strings
+        access_token = create_access_token(identity=str(user.id))
+        payload = {
             'access_token': access_token,
             'user_id': user.id,
             'email': user.email
         }
+        _login_cache.set('test@example.com', payload)
+        return payload
     return {'error': 'User not found'}, 404
 
+_BANNER = "\n".join((
+    "",
+    "=" * 60,
+    "🚀 Flask-Headless-Payments Test Server",
+    "=" * 60,
+    "",
+    "Available Endpoints:",
+    "  GET  /                          - API info",
+    "  GET  /health                    - Health check",
+    "  GET  /api/payments/plans        - List plans",
+    "  POST /test/login                - Get test JWT token",
+    "  GET  /api/payments/subscription - Get subscription (auth required)",
+    "  POST /api/payments/checkout     - Create checkout (auth required)",
+    "  POST /api/payments/portal       - Customer portal (auth required)",
+    "",
+    "Test User:",
+    "  Email: test@example.com",
+    "  Use /test/login to get JWT token",
+    "",
+    "=" * 60,
+    "",
+    "",
+))
+
 if __name__ == '__main__':
-    print("\n" + "="*60)
-    print("🚀 Flask-Headless-Payments Test Server")
-    print("="*60)
-    print("\nAvailable Endpoints:")
-    print("  GET  /                          - API info")
-    print("  GET  /health                    - Health check")
-    print("  GET  /api/payments/plans        - List plans")
-    print("  POST /test/login                - Get test JWT token")
-    print("  GET  /api/payments/subscription - Get subscription (auth required)")
-    print("  POST /api/payments/checkout     - Create checkout (auth required)")
-    print("  POST /api/payments/portal       - Customer portal (auth required)")
-    print("\nTest User:")
-    print("  Email: test@example.com")
-    print("  Use /test/login to get JWT token")
-    print("\n" + "="*60 + "\n")
+    app = create_app()
+    
+    sys.stdout.write(_BANNER)
     
-    app.run(host='0.0.0.0', port=5001, debug=True)
+    app.run(
+        host='0.0.0.0',
+        port=int(os.getenv('PORT', 5001)),
+        debug=os.getenv('FLASK_DEBUG') == '1',
+        use_reloader=False,
+        threaded=True
+    )
 
@@ -0,0 +1,96 @@
+"""
+Shared fixtures: a Flask app with PaymentSvc on a throwaway SQLite database,
+and helpers to post signed Stripe webhook events to it.
+"""
+
+import hashlib
+import hmac
+import json
+import time
+
+import pytest
+from flask import Flask
+from flask_jwt_extended import JWTManager
+from flask_sqlalchemy import SQLAlchemy
+
+from flask_headless_payments import PaymentSvc, SubscriptionMixin
+
+WEBHOOK_SECRET = 'whsec_test'
+
+PLANS = {
+    'free': {'name': 'Free', 'price_id': None},
+    'pro': {'name': 'Pro', 'price_id': 'price_pro'},
+}
+
+
+@pytest.fixture
+def make_app(tmp_path):
+    """
+    Build an app with PaymentSvc and one user (stripe_customer_id='cus_1').
+    
+    Keyword arguments override app config. The sweeper is disabled by
+    default so tests can call WebhookProcessor.redrive() deterministically.
+    models(db) may return extra model arguments for PaymentSvc.
+    """
+    created = []
+    
+    def factory(models=None, **config):
+        app = Flask(__name__)
+        app.config.update(
+            TESTING=True,
+            SECRET_KEY='test-secret-key-' * 2,
+            JWT_SECRET_KEY='test-jwt-secret-' * 2,
+            SQLALCHEMY_DATABASE_URI=f'sqlite:///{tmp_path}/payments.db',
+            STRIPE_API_KEY='sk_test_dummy',
+            STRIPE_WEBHOOK_SECRET=WEBHOOK_SECRET,
+            PAYMENTSVC_WEBHOOK_REDRIVE_INTERVAL=0,
+        )
+        app.config.update(config)
+        
+        db = SQLAlchemy(app)
+        
+        class User(db.Model, SubscriptionMixin):
+            __tablename__ = 'users'
+            id = db.Column(db.Integer, primary_key=True)
+            email = db.Column(db.String(255), unique=True, nullable=False)
+        
+        JWTManager(app)
+        payments = PaymentSvc(app, user_model=User, plans=PLANS, **(models(db) if models else {}))
+        created.append(payments)
+        
+        with app.app_context():
+            db.create_all()
+            db.session.add(User(email='user@example.com', stripe_customer_id='cus_1'))
+            db.session.commit()
+        
+        return app, db, payments
+    
+    yield factory
+    
+    for payments in created:
+        if payments.webhook_processor is not None:
+            payments.webhook_processor.shutdown()
+
+
+def make_event(event_id, event_type, obj):
+    """Build a minimal Stripe event payload."""
+    return {'id': event_id, 'object': 'event', 'type': event_type, 'data': {'object': obj}}
+
+
+def post_event(client, event, timestamp=None):
+    """POST an event to the webhook route with a valid Stripe-Signature header."""
+    body = json.dumps(event)
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signature = hmac.new(
+        WEBHOOK_SECRET.encode(), f'{timestamp}.{body}'.encode(), hashlib.sha256
+    ).hexdigest()
+    return client.post(
+        '/api/payments/webhook',
+        data=body,
+        headers={'Stripe-Signature': f't={timestamp},v1={signature}', 'Content-Type': 'application/json'}
+    )
+
+
+def drain(processor):
+    """Block until every queued event has been processed."""
+    processor._queue.join()
@@ -0,0 +1,61 @@
+"""SubscriptionMixin helpers."""
+
+from datetime import timedelta
+
+from flask_headless_payments import SubscriptionMixin
+from flask_headless_payments.utils.clock import utcnow
+
+
+class Subscriber(SubscriptionMixin):
+    def __init__(self, **fields):
+        defaults = dict.fromkeys((
+            'stripe_customer_id', 'stripe_subscription_id', 'plan_name', 'plan_status',
+            'current_period_start', 'current_period_end', 'cancel_at_period_end',
+            'trial_start', 'trial_end',
+        ))
+        defaults.update(fields)
+        self.__dict__.update(defaults)
+
+
+class LifetimeSubscriber(Subscriber):
+    def is_subscribed(self):
+        return self.plan_name == 'lifetime' or super().is_subscribed()
+
+
+def test_to_subscription_dict_derived_fields():
+    now = utcnow()
+    user = Subscriber(
+        plan_name='pro',
+        plan_status='trialing',
+        trial_end=now + timedelta(days=3),
+        current_period_end=now + timedelta(days=10, hours=1),
+    )
+    
+    data = user.to_subscription_dict()
+    
+    assert data['is_subscribed'] is True
+    assert data['is_on_trial'] is True
+    assert data['days_until_renewal'] == 10
+
+
+def test_to_subscription_dict_respects_overrides():
+    user = LifetimeSubscriber(plan_name='lifetime', plan_status='canceled')
+    
+    assert user.to_subscription_dict()['is_subscribed'] is True
+    assert Subscriber(plan_name='lifetime', plan_status='canceled').to_subscription_dict()['is_subscribed'] is False
+
+
+class LegacyOverrideSubscriber(Subscriber):
+    # Overrides written against the original signatures, without _now
+    def is_on_trial(self):
+        return True
+    
+    def days_until_renewal(self):
+        return 99
+
+
+def test_to_subscription_dict_supports_overrides_without_now():
+    data = LegacyOverrideSubscriber(plan_name='pro', plan_status='active').to_subscription_dict()
+    
+    assert data['is_on_trial'] is True
+    assert data['days_until_renewal'] == 99
@@ -0,0 +1,552 @@
+"""Webhook route and background processing."""
+
+import hashlib
+import hmac
+import io
+import json
+import os
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
+
+import pytest
+import sqlalchemy
+import stripe
+from sqlalchemy import update
+
+from conftest import WEBHOOK_SECRET, drain, make_event, post_event
+from flask_headless_payments.mixins import WebhookEventMixin
+from flask_headless_payments.utils.clock import utcnow
+
+SUBSCRIPTION = {
+    'id': 'sub_1',
+    'object': 'subscription',
+    'customer': 'cus_1',
+    'status': 'active',
+    'current_period_start': 1700000000,
+    'current_period_end': 1900000000,
+    'items': {'data': [{'price': {'id': 'price_pro', 'metadata': {'plan_name': 'pro'}}}]},
+}
+
+
+def _rows(app, payments):
+    model = payments.webhook_event_model
+    with app.app_context():
+        return {
+            row.stripe_event_id: (row.processed, row.error)
+            for row in model.query.all()
+        }
+
+
+def test_sync_event_is_processed_in_request(make_app):
+    app, db, payments = make_app()
+    client = app.test_client()
+    
+    response = post_event(client, make_event('evt_1', 'customer.subscription.created', SUBSCRIPTION))
+    
+    assert response.status_code == 200
+    assert response.json == {'status': 'success'}
+    assert _rows(app, payments) == {'evt_1': (True, None)}
+
+
+def test_sync_failure_returns_500_and_retry_succeeds(make_app):
+    app, db, payments = make_app()
+    client = app.test_client()
+    calls = []
+    
+    def flaky(event_data, db, user_model, commit=False):
+        calls.append(event_data['id'])
+        if len(calls) == 1:
+            raise RuntimeError('boom')
+    
+    payments.register_webhook_handler('customer.updated', flaky)
+    event = make_event('evt_1', 'customer.updated', {'id': 'cus_1'})
+    
+    assert post_event(client, event).status_code == 500
+    assert _rows(app, payments) == {'evt_1': (False, 'boom')}
+    
+    assert post_event(client, event).status_code == 200
+    assert _rows(app, payments) == {'evt_1': (True, None)}
+    assert len(calls) == 2
+
+
+def test_async_event_is_queued_then_processed(make_app):
+    app, db, payments = make_app(PAYMENTSVC_WEBHOOK_ASYNC=True)
+    client = app.test_client()
+    
+    response = post_event(client, make_event('evt_1', 'customer.subscription.created', SUBSCRIPTION))
+    assert response.json == {'status': 'queued'}
+    
+    drain(payments.webhook_processor)
+    assert _rows(app, payments) == {'evt_1': (True, None)}
+    with app.app_context():
+        user = payments.user_model.query.one()
+        assert user.plan_name == 'pro'
+        assert user.plan_status == 'active'
+
+
+def test_async_duplicate_is_not_processed_twice(make_app):
+    app, db, payments = make_app(PAYMENTSVC_WEBHOOK_ASYNC=True)
+    client = app.test_client()
+    calls = []
+    payments.register_webhook_handler('customer.updated', lambda data, *args, **kwargs: calls.append(data))
+    event = make_event('evt_1', 'customer.updated', {'id': 'cus_1'})
+    
+    assert post_event(client, event).json == {'status': 'queued'}
+    drain(payments.webhook_processor)
+    assert post_event(client, event).json == {'status': 'duplicate'}
+    drain(payments.webhook_processor)
+    
+    assert len(calls) == 1
+    assert payments.webhook_processor.redrive() == 0
+
+
+def test_async_failure_is_retried_by_redrive(make_app):
+    app, db, payments = make_app(PAYMENTSVC_WEBHOOK_ASYNC=True)
+    client = app.test_client()
+    processor = payments.webhook_processor
+    calls = []
+    
+    def flaky(event_data, db, user_model, commit=False):
+        calls.append(event_data['id'])
+        if len(calls) == 1:
+            raise RuntimeError('boom')
+    
+    payments.register_webhook_handler('customer.updated', flaky)
+    
+    assert post_event(client, make_event('evt_1', 'customer.updated', {'id': 'cus_1'})).json == {'status': 'queued'}
+    drain(processor)
+    assert _rows(app, payments) == {'evt_1': (False, 'boom')}
+    
+    assert processor.redrive() == 1
+    drain(processor)
+    assert _rows(app, payments) == {'evt_1': (True, None)}
+    assert len(calls) == 2
+    assert processor.get_stats()['redriven'] == 1
+
+
+def test_redrive_gives_up_after_max_retries(make_app):
+    app, db, payments = make_app(PAYMENTSVC_WEBHOOK_ASYNC=True, PAYMENTSVC_WEBHOOK_MAX_RETRIES=2)
+    client = app.test_client()
+    processor = payments.webhook_processor
+    
+    def broken(event_data, db, user_model, commit=False):
+        raise RuntimeError('boom')
+    
+    payments.register_webhook_handler('customer.updated', broken)
+    post_event(client, make_event('evt_1', 'customer.updated', {'id': 'cus_1'}))
+    drain(processor)
+    
+    for _ in range(2):
+        assert processor.redrive() == 1
+        drain(processor)
+    
+    assert processor.redrive() == 0
+    assert processor.get_stats()['exhausted'] == 1
+    assert _rows(app, payments) == {'evt_1': (False, 'boom')}
+
+
+def test_stranded_row_is_reclaimed_by_resend(make_app):
+    app, db, payments = make_app(PAYMENTSVC_WEBHOOK_STALE_AFTER=0)
+    client = app.test_client()
+    event = make_event('evt_1', 'customer.subscription.created', SUBSCRIPTION)
+    
+    # Recorded by a process that exited before its worker got to the row
+    with app.app_context():
+        assert payments.webhook_manager.record_event(event) is not None
+    assert _rows(app, payments) == {'evt_1': (False, None)}
+    
+    assert post_event(client, event).json == {'status': 'success'}
+    assert _rows(app, payments) == {'evt_1': (True, None)}
+
+
+def test_fresh_unprocessed_row_is_still_a_duplicate(make_app):
+    app, db, payments = make_app()
+    client = app.test_client()
+    event = make_event('evt_1', 'customer.subscription.created', SUBSCRIPTION)
+    
+    with app.app_context():
+        payments.webhook_manager.record_event(event)
+    
+    assert post_event(client, event).json == {'status': 'success'}
+    assert _rows(app, payments) == {'evt_1': (False, None)}
+
+
+def test_queue_full_processes_in_request(make_app):
+    app, db, payments = make_app(
+        PAYMENTSVC_WEBHOOK_ASYNC=True,
+        PAYMENTSVC_WEBHOOK_WORKERS=1,
+        PAYMENTSVC_WEBHOOK_QUEUE_SIZE=1,
+    )
+    client = app.test_client()
+    processor = payments.webhook_processor
+    started = threading.Event()
+    release = threading.Event()
+    
+    def blocking(event_data, db, user_model, commit=False):
+        if event_data['id'] == 'cus_block':
+            started.set()
+            release.wait(5)
+    
+    payments.register_webhook_handler('customer.updated', blocking)
+    
+    assert post_event(client, make_event('evt_1', 'customer.updated', {'id': 'cus_block'})).json == {'status': 'queued'}
+    assert started.wait(5)
+    assert post_event(client, make_event('evt_2', 'customer.updated', {'id': 'cus_2'})).json == {'status': 'queued'}
+    
+    # Worker busy and queue full - handled synchronously instead of dropped
+    response = post_event(client, make_event('evt_3', 'customer.updated', {'id': 'cus_3'}))
+    assert response.json == {'status': 'success'}
+    assert _rows(app, payments)['evt_3'] == (True, None)
+    assert processor.get_stats()['dropped'] == 1
+    
+    release.set()
+    drain(processor)
+    assert all(processed for processed, _ in _rows(app, payments).values())
+
+
+def test_workers_restart_after_fork(make_app, monkeypatch):
+    app, db, payments = make_app(PAYMENTSVC_WEBHOOK_ASYNC=True, PAYMENTSVC_WEBHOOK_WORKERS=2)
+    processor = payments.webhook_processor
+    parent_threads = list(processor._threads)
+    
+    monkeypatch.setattr(os, 'getpid', lambda: -1)
+    
+    assert not processor.is_full()
+    assert processor._threads and processor._threads != parent_threads
+    assert processor.get_stats()['workers'] == 2
+    
+    response = post_event(app.test_client(), make_event('evt_1', 'customer.subscription.created', SUBSCRIPTION))
+    assert response.json == {'status': 'queued'}
+    drain(processor)
+    assert _rows(app, payments) == {'evt_1': (True, None)}
+
+
+def test_metrics_disabled_by_default(make_app):
+    app, db, payments = make_app(PAYMENTSVC_WEBHOOK_ASYNC=True)
+    
+    assert app.test_client().get('/api/payments/webhook/metrics').status_code == 404
+
+
+def test_metrics_enabled(make_app):
+    app, db, payments = make_app(PAYMENTSVC_WEBHOOK_ASYNC=True, PAYMENTSVC_WEBHOOK_METRICS=True)
+    
+    response = app.test_client().get('/api/payments/webhook/metrics')
+    assert response.status_code == 200
+    assert response.json['async'] is True
+    assert response.json['workers'] == 4
+
+
+def test_duplicate_detected_without_unique_index(make_app):
+    def models(db):
+        class LooseWebhookEvent(db.Model, WebhookEventMixin):
+            __tablename__ = 'loose_webhook_events'
+            id = db.Column(db.Integer, primary_key=True)
+            stripe_event_id = db.Column(db.String(255), nullable=False)
+        
+        return {'webhook_event_model': LooseWebhookEvent}
+    
+    app, db, payments = make_app(models=models)
+    client = app.test_client()
+    event = make_event('evt_1', 'customer.subscription.created', SUBSCRIPTION)
+    
+    assert not payments.webhook_manager._stripe_event_id_unique
+    assert post_event(client, event).json == {'status': 'success'}
+    assert post_event(client, event).json == {'status': 'success'}
+    assert _rows(app, payments) == {'evt_1': (True, None)}
+    with app.app_context():
+        assert payments.webhook_event_model.query.count() == 1
+
+
+@pytest.mark.parametrize('asynchronous', [False, True])
+def test_handlers_get_attribute_access(make_app, asynchronous):
+    app, db, payments = make_app(PAYMENTSVC_WEBHOOK_ASYNC=asynchronous)
+    seen = []
+    payments.register_webhook_handler(
+        'customer.updated', lambda data, *args, **kwargs: seen.append((data.id, data['email']))
+    )
+    
+    post_event(app.test_client(), make_event('evt_1', 'customer.updated', {'id': 'cus_1', 'email': 'a@b.c'}))
+    if asynchronous:
+        drain(payments.webhook_processor)
+    
+    assert seen == [('cus_1', 'a@b.c')]
+    assert _rows(app, payments) == {'evt_1': (True, None)}
+
+
+def test_batch_prefetch_keeps_callback_payload(make_app):
+    app, db, payments = make_app()
+    manager = payments.webhook_manager
+    seen = []
+    manager.register_post_commit_callback(
+        'checkout.session.completed', lambda data, user_model, user: seen.append(data['subscription'])
+    )
+    
+    with app.app_context():
+        row_ids = [
+            manager.record_event(make_event(
+                f'evt_{i}', 'checkout.session.completed',
+                {'id': f'cs_{i}', 'customer': 'cus_1', 'subscription': f'sub_{i}'}
+            ))
+            for i in (1, 2)
+        ]
+        with mock.patch('stripe.Subscription.retrieve', side_effect=lambda sub_id: {**SUBSCRIPTION, 'id': sub_id}) as retrieve:
+            assert manager.process_recorded_events(row_ids) == [True, True]
+    
+    assert retrieve.call_count == 2
+    assert seen == ['sub_1', 'sub_2']
+    with app.app_context():
+        assert payments.user_model.query.one().stripe_subscription_id == 'sub_2'
+
+
+def test_batch_prefetch_only_feeds_checkout_events(make_app):
+    app, db, payments = make_app()
+    manager = payments.webhook_manager
+    events = [
+        make_event('evt_1', 'checkout.session.completed', {'id': 'cs_1', 'customer': 'cus_1', 'subscription': 'sub_1'}),
+        make_event('evt_2', 'checkout.session.completed', {'id': 'cs_2', 'customer': 'cus_1', 'subscription': 'sub_2'}),
+        make_event('evt_3', 'invoice.paid', {'id': 'in_1', 'customer': 'cus_1', 'subscription': 'sub_1'}),
+    ]
+    
+    with app.app_context():
+        row_ids = [manager.record_event(event) for event in events]
+        with mock.patch('stripe.Subscription.retrieve', side_effect=lambda sub_id: {**SUBSCRIPTION, 'id': sub_id}), \
+                mock.patch.object(manager, '_handle_checkout_completed', wraps=manager._handle_checkout_completed) as checkout:
+            assert manager.process_recorded_events(row_ids) == [True, True, True]
+    
+    assert [call.args[0]['id'] for call in checkout.call_args_list] == ['cs_1', 'cs_2']
+    with app.app_context():
+        assert payments.user_model.query.one().stripe_subscription_id == 'sub_2'
+
+
+def test_batch_loads_users_once(make_app):
+    app, db, payments = make_app()
+    manager = payments.webhook_manager
+    user_selects = []
+    
+    def count_user_selects(conn, cursor, statement, *args):
+        if statement.startswith('SELECT') and 'FROM users' in statement:
+            user_selects.append(statement)
+    
+    with app.app_context():
+        row_ids = [
+            manager.record_event(make_event(f'evt_{i}', 'customer.subscription.updated', SUBSCRIPTION))
+            for i in (1, 2, 3)
+        ]
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute', count_user_selects)
+        try:
+            assert manager.process_recorded_events(row_ids) == [True, True, True]
+        finally:
+            sqlalchemy.event.remove(db.engine, 'before_cursor_execute', count_user_selects)
+        
+        # Outside a batch nothing is remembered: a plain lookup per call
+        assert db.session().info == {}
+        assert manager._get_user_by_customer('cus_1').email == 'user@example.com'
+    
+    assert len(user_selects) == 1
+
+
+def test_plan_falls_back_to_price_id(make_app):
+    app, db, payments = make_app()
+    subscription = {
+        **SUBSCRIPTION,
+        'items': {'data': [{'price': {'id': 'price_pro', 'metadata': {}}}]},
+    }
+    
+    post_event(app.test_client(), make_event('evt_1', 'customer.subscription.created', subscription))
+    
+    with app.app_context():
+        assert payments.user_model.query.one().plan_name == 'pro'
+
+
+def test_worker_skips_row_reclaimed_elsewhere(make_app):
+    app, db, payments = make_app()
+    manager = payments.webhook_manager
+    model = payments.webhook_event_model
+    calls = []
+    payments.register_webhook_handler('customer.updated', lambda data, *args, **kwargs: calls.append(data))
+    
+    with app.app_context():
+        row_id = manager.record_event(make_event('evt_1', 'customer.updated', {'id': 'cus_1'}))
+        queued_at = utcnow()
+        # Another process's sweeper took the row over after it was queued here
+        db.session.execute(
+            update(model).where(model.id == row_id).values(received_at=queued_at + timedelta(seconds=301))
+        )
+        db.session.commit()
+        
+        assert manager.process_recorded_events([row_id], queued_at={row_id: queued_at}) == [True]
+    
+    assert calls == []
+    assert _rows(app, payments) == {'evt_1': (False, None)}
+
+
+def test_leased_row_is_not_swept_while_processing(make_app):
+    app, db, payments = make_app()
+    manager = payments.webhook_manager
+    model = payments.webhook_event_model
+    swept = []
+    
+    def handler(event_data, db, user_model, commit=False):
+        def sweep():
+            with app.app_context():
+                swept.extend(manager.claim_stale_events())
+        
+        thread = threading.Thread(target=sweep)
+        thread.start()
+        thread.join()
+    
+    payments.register_webhook_handler('customer.updated', handler)
+    
+    with app.app_context():
+        row_id = manager.record_event(make_event('evt_1', 'customer.updated', {'id': 'cus_1'}))
+        # Waited in the queue for longer than PAYMENTSVC_WEBHOOK_STALE_AFTER
+        received_at = utcnow() - timedelta(seconds=400)
+        db.session.execute(update(model).where(model.id == row_id).values(received_at=received_at))
+        db.session.commit()
+        
+        assert manager.process_recorded_events([row_id], queued_at={row_id: received_at}) == [True]
+    
+    assert swept == []
+    assert _rows(app, payments) == {'evt_1': (True, None)}
+
+
+def test_signature_tolerance_is_applied(make_app):
+    app, db, payments = make_app(PAYMENTSVC_WEBHOOK_TOLERANCE=60)
+    client = app.test_client()
+    event = make_event('evt_1', 'customer.subscription.created', SUBSCRIPTION)
+    
+    with mock.patch.object(stripe.WebhookSignature, 'verify_header',
+                           wraps=stripe.WebhookSignature.verify_header) as verify:
+        assert post_event(client, event, timestamp=int(time.time()) - 120).status_code == 400
+        assert post_event(client, event).status_code == 200
+    
+    assert [call.args[3] for call in verify.call_args_list] == [60, 60]
+
+
+INVOICE = {'id': 'in_1', 'object': 'invoice', 'customer': 'cus_1', 'subscription': 'sub_1'}
+
+
+@pytest.mark.parametrize('asynchronous', [False, True])
+def test_invoice_events_are_not_stored_by_default(make_app, asynchronous):
+    app, db, payments = make_app(PAYMENTSVC_WEBHOOK_ASYNC=asynchronous)
+    
+    response = post_event(app.test_client(), make_event('evt_1', 'invoice.payment_succeeded', INVOICE))
+    
+    assert response.status_code == 200
+    assert response.json == {'status': 'success'}
+    assert _rows(app, payments) == {}
+
+
+def test_registered_handler_disables_skip(make_app):
+    app, db, payments = make_app()
+    calls = []
+    payments.register_webhook_handler('invoice.payment_succeeded', lambda data, *args, **kwargs: calls.append(data))
+    
+    post_event(app.test_client(), make_event('evt_1', 'invoice.payment_succeeded', INVOICE))
+    
+    assert len(calls) == 1
+    assert _rows(app, payments) == {'evt_1': (True, None)}
+
+
+def test_post_commit_callback_disables_skip(make_app):
+    app, db, payments = make_app()
+    calls = []
+    payments.webhook_manager.register_post_commit_callback(
+        'invoice.payment_failed', lambda data, user_model, user: calls.append(user)
+    )
+    
+    post_event(app.test_client(), make_event('evt_1', 'invoice.payment_failed', INVOICE))
+    
+    assert len(calls) == 1
+    assert _rows(app, payments) == {'evt_1': (True, None)}
+
+
+def test_empty_skip_persist_keeps_invoice_rows(make_app):
+    app, db, payments = make_app(PAYMENTSVC_WEBHOOK_SKIP_PERSIST=[])
+    
+    response = post_event(app.test_client(), make_event('evt_1', 'invoice.payment_succeeded', INVOICE))
+    
+    assert response.json == {'status': 'success'}
+    assert _rows(app, payments) == {'evt_1': (True, None)}
+
+
+class CountingStream(io.BytesIO):
+    """Request body that records how many bytes the route read."""
+    
+    bytes_read = 0
+    
+    def read(self, size=-1):
+        data = super().read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def _post_raw(client, stream, headers, content_length=None):
+    environ = {'wsgi.input_terminated': True}
+    if content_length is not None:
+        environ['CONTENT_LENGTH'] = str(content_length)
+    return client.post('/api/payments/webhook', input_stream=stream, headers=headers, environ_overrides=environ)
+
+
+def test_oversized_body_with_content_length_gets_413_unread(make_app):
+    app, db, payments = make_app(PAYMENTSVC_WEBHOOK_MAX_BYTES=100)
+    stream = CountingStream(b'x' * 1000)
+    
+    with mock.patch.object(payments.webhook_manager, 'verify_webhook') as verify:
+        response = _post_raw(app.test_client(), stream, {'Stripe-Signature': 't=1,v1=abc'}, content_length=1000)
+    
+    assert response.status_code == 413
+    assert stream.bytes_read == 0
+    verify.assert_not_called()
+
+
+def test_oversized_chunked_body_gets_413_after_limit(make_app):
+    app, db, payments = make_app(PAYMENTSVC_WEBHOOK_MAX_BYTES=100)
+    stream = CountingStream(b'x' * 100000)
+    
+    with mock.patch.object(payments.webhook_manager, 'verify_webhook') as verify:
+        response = _post_raw(
+            app.test_client(), stream, {'Stripe-Signature': 't=1,v1=abc', 'Transfer-Encoding': 'chunked'}
+        )
+    
+    assert response.status_code == 413
+    assert stream.bytes_read == 101
+    verify.assert_not_called()
+
+
+def test_chunked_body_within_limit_is_accepted(make_app):
+    app, db, payments = make_app()
+    client = app.test_client()
+    event = make_event('evt_1', 'customer.subscription.created', SUBSCRIPTION)
+    timestamp = int(time.time())
+    body = json.dumps(event).encode()
+    signature = hmac.new(WEBHOOK_SECRET.encode(), f'{timestamp}.'.encode() + body, hashlib.sha256).hexdigest()
+    
+    response = _post_raw(client, CountingStream(body), {
+        'Stripe-Signature': f't={timestamp},v1={signature}', 'Transfer-Encoding': 'chunked'
+    })
+    
+    assert response.json == {'status': 'success'}
+
+
+def test_missing_signature_rejected_before_body_is_read(make_app):
+    app, db, payments = make_app()
+    stream = CountingStream(json.dumps(make_event('evt_1', 'customer.updated', {'id': 'cus_1'})).encode())
+    
+    response = _post_raw(app.test_client(), stream, {}, content_length=len(stream.getvalue()))
+    
+    assert response.status_code == 400
+    assert stream.bytes_read == 0
+    assert _rows(app, payments) == {}
+
+
+def test_signature_compared_in_constant_time(make_app):
+    app, db, payments = make_app()
+    
+    with mock.patch('hmac.compare_digest', wraps=hmac.compare_digest) as compare_digest:
+        response = post_event(app.test_client(), make_event('evt_1', 'customer.subscription.created', SUBSCRIPTION))
+    
+    assert response.status_code == 200
+    compare_digest.assert_called()